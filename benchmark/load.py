@@ -0,0 +1,334 @@
+import re
+import sys
+from argparse import ArgumentParser
+from asyncio import TimeoutError, create_task, gather, run, shield, sleep, wait_for
+from collections import deque
+from configparser import ConfigParser
+from math import ceil
+from os import environ
+from pathlib import Path
+from random import Random
+from subprocess import DEVNULL, Popen
+from tempfile import NamedTemporaryFile
+from time import perf_counter
+
+from mock_ryver import ADMIN_USERNAME, BOT_USERNAME, MockRyver
+from rich.console import Console
+from rich.table import Table
+
+console = Console()
+
+bot_dir = Path(__file__).parent.parent.absolute()
+
+# Messages the driver sends on their own, with the number of replies each should get
+# and a pattern their replies match (None for questions, which could be anything)
+MESSAGES = {
+    "topic": ("!topic", 1, r"Conversation starter"),
+    "trivia": ("!trivia", 1, None),
+    "poll": ("!poll What's for lunch?;Pizza;Tacos;Salad", 1, r"^# What's for lunch\?"),
+    "chatter": (None, 0, None),
+}
+
+CHATTER = [
+    "morning everyone",
+    "did the build go green?",
+    "lol",
+    "anyone up for lunch later",
+    "I'll push the fix in a bit",
+    "that meeting could have been an email",
+]
+
+JUDGE = re.compile(r"@(\S+) is the judge")
+
+
+def percentile(values, percent: float):
+    """Nearest-rank percentile of sorted values."""
+    if not values:
+        return None
+    return values[max(0, ceil(percent / 100 * len(values)) - 1)]
+
+
+def parse_mix(text: str):
+    mix = {}
+    for part in text.split(","):
+        kind, _, weight = part.partition("=")
+        kind = kind.strip()
+        if kind not in MESSAGES and kind != "cah":
+            raise ValueError(f"Unknown message kind {kind!r}")
+        mix[kind] = float(weight or 1)
+    return mix
+
+
+# Fires a mix of messages at the mock Ryver at a fixed rate and records reply latencies
+class LoadDriver:
+    def __init__(self, mock: MockRyver, rate: float, mix, timeout: float, seed=None):
+        self.mock = mock
+        self.rate = rate
+        self.kinds = list(mix)
+        self.weights = list(mix.values())
+        self.timeout = timeout
+        self.random = Random(seed)
+        self.usernames = [
+            user["username"]
+            for user in mock.users
+            if user["username"] not in (BOT_USERNAME, ADMIN_USERNAME)
+        ]
+        self.free_cah_chats = deque(chat["id"] for chat in mock.cah_chats)
+        # Kind -> sent, latencies, errors and skipped counts
+        self.stats = {
+            kind: {"sent": 0, "latencies": [], "errors": 0, "skipped": 0}
+            for kind in self.kinds
+        }
+
+    async def run(self, duration: float):
+        """
+        Send messages on a fixed schedule for `duration` seconds, without waiting for
+        replies first, so a slow bot shows up as latency instead of a lower send rate.
+        """
+        tasks = []
+        started = perf_counter()
+        sent = 0
+        while perf_counter() - started < duration:
+            kind = self.random.choices(self.kinds, self.weights)[0]
+            if kind == "cah":
+                tasks.append(create_task(self.cah_round()))
+            else:
+                tasks.append(create_task(self.message(kind)))
+            sent += 1
+            delay = started + sent / self.rate - perf_counter()
+            if delay > 0:
+                await sleep(delay)
+        elapsed = perf_counter() - started
+        await gather(*tasks)
+        return elapsed
+
+    async def exchange(
+        self,
+        kind: str,
+        chat_id: int,
+        username: str,
+        text: str,
+        replies: int,
+        pattern=None,
+    ):
+        """Say something and wait for every expected reply, returning the Exchange or None."""
+        stats = self.stats[kind]
+        stats["sent"] += 1
+        exchange = await self.mock.say(chat_id, username, text, replies, pattern)
+        if replies == 0:
+            return exchange
+        try:
+            await wait_for(shield(exchange.done), self.timeout)
+        except TimeoutError:
+            self.mock.forget(exchange)
+            if not exchange.first.done():
+                stats["errors"] += 1
+                return None
+        stats["latencies"].append(exchange.first.result())
+        return exchange
+
+    async def message(self, kind: str):
+        text, replies, pattern = MESSAGES[kind]
+        if text is None:
+            text = self.random.choice(CHATTER)
+        chat_id = self.random.choice(self.mock.chats)["id"]
+        username = self.random.choice(self.usernames)
+        await self.exchange(kind, chat_id, username, text, replies, pattern)
+
+    async def cah_round(self):
+        """Play a one round game of CAH in a chat of its own."""
+        if not self.free_cah_chats:
+            self.stats["cah"]["skipped"] += 1
+            return
+        chat_id = self.free_cah_chats.popleft()
+        host, *others = self.random.sample(self.usernames, 3)
+        finished = False
+        try:
+            if await self.exchange("cah", chat_id, host, "!cah 1", 1) is None:
+                return
+            for player in others:
+                if await self.exchange("cah", chat_id, player, "!join", 1) is None:
+                    return
+
+            # The black card and the judge are announced
+            start = await self.exchange("cah", chat_id, host, "!start", 2)
+            if start is None:
+                return
+            judge = next(
+                (m[1] for m in map(JUDGE.search, start.texts) if m is not None), None
+            )
+            if judge is None:
+                self.stats["cah"]["errors"] += 1
+                return
+
+            # The last card played also asks the judge to pick a winner
+            playing = [name for name in (host, *others) if name != judge]
+            for i, player in enumerate(playing):
+                replies = 2 if i == len(playing) - 1 else 1
+                if (
+                    await self.exchange("cah", chat_id, player, "!card 1", replies)
+                    is None
+                ):
+                    return
+
+            # The winner and the end of the game are announced
+            finished = (
+                await self.exchange("cah", chat_id, judge, "!pick 1", 2) is not None
+            )
+        finally:
+            if not finished:
+                await self.exchange("cah", chat_id, host, "!end", 1)
+            self.free_cah_chats.append(chat_id)
+
+    def report(self, elapsed: float):
+        table = Table(title=f"Reply latency over {elapsed:.1f}s")
+        for column in (
+            "Kind",
+            "Sent",
+            "Replies",
+            "Errors",
+            "Error rate",
+            "p50",
+            "p95",
+            "p99",
+        ):
+            table.add_column(column, justify="left" if column == "Kind" else "right")
+
+        def row(kind, stats):
+            latencies = sorted(stats["latencies"])
+            expected = stats["sent"] if kind != "chatter" else 0
+            error_rate = stats["errors"] / expected if expected else 0
+            cells = [
+                f"{value * 1000:.0f}ms" if value is not None else "-"
+                for value in (percentile(latencies, p) for p in (50, 95, 99))
+            ]
+            table.add_row(
+                kind,
+                str(stats["sent"]),
+                str(len(latencies)),
+                str(stats["errors"]),
+                f"{error_rate:.1%}",
+                *cells,
+            )
+
+        for kind, stats in self.stats.items():
+            row(kind, stats)
+        total = {
+            "sent": sum(s["sent"] for k, s in self.stats.items() if k != "chatter"),
+            "latencies": [l for s in self.stats.values() for l in s["latencies"]],
+            "errors": sum(s["errors"] for s in self.stats.values()),
+        }
+        row("all", total)
+        console.print(table)
+
+        sent = sum(stats["sent"] for stats in self.stats.values())
+        console.print(f"Sent {sent / elapsed:.1f} messages/s")
+        skipped = self.stats.get("cah", {}).get("skipped")
+        if skipped:
+            console.print(f"Skipped {skipped} CAH rounds with no free CAH chat")
+        if self.mock.unknown:
+            console.print("[yellow]Unhandled API calls:")
+            for call, calls in self.mock.unknown.most_common():
+                console.print(f"  {calls} x {call}")
+
+
+def bot_config(extra_chats: str):
+    """
+    Write a config for the spawned bot, from brainbot.ini (or the example config) with
+    every mock chat added to extra_chats.
+    """
+    config = ConfigParser(interpolation=None)
+    config.read([bot_dir / "brainbot.ini.example", bot_dir / "brainbot.ini"])
+    if not config.has_section("misc"):
+        config.add_section("misc")
+    config.set("misc", "extra_chats", extra_chats)
+    with NamedTemporaryFile("w", suffix=".ini", delete=False) as file:
+        config.write(file)
+    return Path(file.name)
+
+
+async def main(args):
+    mix = parse_mix(args.mix)
+    mock = MockRyver(
+        chats=args.chats,
+        cah_chats=args.cah_chats if "cah" in mix else 0,
+        users=args.users,
+    )
+    await mock.start(args.host, args.port)
+    extra_chats = ",".join(str(chat["id"]) for chat in mock.forums[1:])
+
+    bot = None
+    config_path = None
+    if args.spawn_bot:
+        config_path = bot_config(extra_chats)
+        env = dict(
+            environ,
+            BRAINBOT_CONFIG=str(config_path),
+            RYVER_API_URL=mock.api_url,
+            RYVER_ORG="mock",
+            RYVER_USER=BOT_USERNAME,
+            RYVER_PASS="mock",
+            RYVER_CHAT=str(mock.chats[0]["id"]),
+            BOT_ADMIN=ADMIN_USERNAME,
+        )
+        log = open(args.bot_log, "w") if args.bot_log else DEVNULL
+        bot = Popen(
+            [sys.executable, "main.py"], cwd=bot_dir, env=env, stdout=log, stderr=log
+        )
+    else:
+        if extra_chats:
+            console.print(
+                "Make sure brainbot.ini has "
+                f"[bold]extra_chats={extra_chats}[/bold] under [misc]"
+            )
+        console.print(
+            f"Waiting for the bot to connect with RYVER_API_URL={mock.api_url}"
+        )
+
+    try:
+        await wait_for(mock.connected.wait(), args.connect_timeout)
+        console.print(
+            f"Bot connected, sending {args.rate} messages/s for {args.duration}s"
+        )
+        driver = LoadDriver(mock, args.rate, mix, args.timeout, args.seed)
+        elapsed = await driver.run(args.duration)
+        driver.report(elapsed)
+    finally:
+        if bot is not None:
+            bot.terminate()
+            bot.wait()
+        if config_path is not None:
+            config_path.unlink()
+        await mock.close()
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        description="Measure BrainBot's reply latency against a local mock Ryver"
+    )
+    parser.add_argument("--rate", type=float, default=5.0, help="messages per second")
+    parser.add_argument(
+        "--duration", type=float, default=30.0, help="seconds to send for"
+    )
+    parser.add_argument(
+        "--mix",
+        default="topic=2,trivia=2,poll=1,cah=1,chatter=10",
+        help="weights of each kind of message (topic, trivia, poll, cah, chatter)",
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=10.0, help="seconds to wait for a reply"
+    )
+    parser.add_argument(
+        "--chats", type=int, default=1, help="chats to spread messages over"
+    )
+    parser.add_argument("--cah-chats", type=int, default=4, help="chats for CAH games")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument(
+        "--spawn-bot", action="store_true", help="run main.py against the mock"
+    )
+    parser.add_argument("--bot-log", help="file to write the spawned bot's output to")
+    parser.add_argument("--connect-timeout", type=float, default=120.0)
+    run(main(parser.parse_args()))
@@ -0,0 +1,331 @@
+import re
+from argparse import ArgumentParser
+from asyncio import Event, get_running_loop, sleep
+from collections import Counter, deque
+from itertools import count
+from time import perf_counter
+from urllib.parse import unquote
+
+from aiohttp import WSMsgType, web
+
+# Entity types of the chat collections pyryver loads, by their API type
+ENTITY_TYPES = {
+    "users": "Entity.User",
+    "forums": "Entity.Forum",
+    "workrooms": "Entity.Workroom",
+}
+
+# "<type>(<id>)/<action>" as used in pyryver's API URLs, every part optional
+API_PATH = re.compile(
+    r"^(?:(?P<type>[A-Za-z]+)(?:\((?P<id>\d+)\))?(?:/|$))?(?P<action>.*)$"
+)
+
+BOT_ID = 1
+BOT_USERNAME = "brainbot"
+ADMIN_USERNAME = "admin"
+
+
+# A message said in a chat and the bot's replies to it
+class Exchange:
+    __slots__ = (
+        "message_id",
+        "chat_id",
+        "pattern",
+        "sent",
+        "expected",
+        "texts",
+        "first",
+        "done",
+    )
+
+    def __init__(self, message_id: str, chat_id: int, expected: int, pattern=None):
+        loop = get_running_loop()
+        self.message_id = message_id
+        self.chat_id = chat_id
+        # Regex the replies to this message match, or None to take any other reply
+        self.pattern = re.compile(pattern) if pattern is not None else None
+        self.sent = perf_counter()
+        self.expected = expected
+        self.texts = []
+        # Seconds until the first reply, and until every expected reply arrived
+        self.first = loop.create_future()
+        self.done = loop.create_future()
+
+    def reply(self, text: str = None, final: bool = False):
+        elapsed = perf_counter() - self.sent
+        if not self.first.done():
+            self.first.set_result(elapsed)
+        if text is not None:
+            self.texts.append(text)
+        if final or len(self.texts) >= self.expected:
+            if not self.done.done():
+                self.done.set_result(elapsed)
+        return self.done.done()
+
+
+# Local stand-in for the parts of the Ryver REST and websocket APIs that pyryver uses
+class MockRyver:
+    def __init__(self, chats: int = 1, cah_chats: int = 0, users: int = 50):
+        self.users = [self.entity("users", BOT_ID, BOT_USERNAME)]
+        self.users.append(self.entity("users", 2, ADMIN_USERNAME))
+        self.users += [self.entity("users", 10 + i, f"user{i}") for i in range(users)]
+        # Chats the driver talks in, and chats reserved for whole CAH games
+        self.chats = [self.entity("forums", 100 + i, f"chat{i}") for i in range(chats)]
+        self.cah_chats = [
+            self.entity("forums", 200 + i, f"cah{i}") for i in range(cah_chats)
+        ]
+        self.forums = self.chats + self.cah_chats
+        self.by_id = {entity["id"]: entity for entity in self.users + self.forums}
+
+        self.message_ids = count(1)
+        self.messages = {}
+        # Exchanges waiting for replies, oldest first, by chat ID
+        self.pending = {entity["id"]: deque() for entity in self.forums}
+        self.exchanges = {}
+
+        self.sockets = set()
+        self.connected = Event()
+        self.requests = Counter()
+        self.unknown = Counter()
+
+        self.app = web.Application()
+        self.app.router.add_get("/ws", self.websocket)
+        self.app.router.add_route("*", "/api/1/odata.svc/{path:.*}", self.api)
+        self.runner = None
+        self.host = "127.0.0.1"
+        self.port = 0
+
+    @staticmethod
+    def entity(obj_type: str, id: int, name: str):
+        return {
+            "__metadata": {"type": ENTITY_TYPES[obj_type]},
+            "id": id,
+            "jid": f"{name}@mock.ryver.com",
+            "username": name,
+            "name": name,
+            "nickname": name,
+            "displayName": name,
+            "emailAddress": f"{name}@example.com",
+            "timeZone": "UTC",
+        }
+
+    @property
+    def api_url(self):
+        return f"http://{self.host}:{self.port}/api/1/odata.svc/"
+
+    @property
+    def ws_url(self):
+        return f"ws://{self.host}:{self.port}/ws"
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0):
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        self.host = host
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        for ws in list(self.sockets):
+            await ws.close()
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+    async def say(
+        self, chat_id: int, username: str, text: str, replies: int = 1, pattern=None
+    ):
+        """
+        Post a chat message to the bot's live session, returning its Exchange. Replies
+        are matched to it by `pattern` if given.
+        """
+        message_id = f"m{next(self.message_ids)}"
+        user = next(user for user in self.users if user["username"] == username)
+        chat = self.by_id[chat_id]
+        self.messages[message_id] = self.message(message_id, chat, text, user["id"])
+
+        exchange = Exchange(message_id, chat_id, replies, pattern)
+        if replies > 0:
+            self.pending[chat_id].append(exchange)
+            self.exchanges[message_id] = exchange
+        data = {
+            "type": "chat",
+            "key": message_id,
+            "from": user["jid"],
+            "to": chat["jid"],
+            "text": text,
+        }
+        for ws in list(self.sockets):
+            await ws.send_json(data)
+        return exchange
+
+    def forget(self, exchange: Exchange):
+        self.exchanges.pop(exchange.message_id, None)
+        try:
+            self.pending[exchange.chat_id].remove(exchange)
+        except ValueError:
+            pass
+
+    @staticmethod
+    def message(message_id: str, chat: dict, text: str, user_id: int):
+        return {
+            "id": message_id,
+            "body": text,
+            "from": {"id": user_id},
+            "to": {"id": chat["id"], "__metadata": chat["__metadata"]},
+            "__reactions": {},
+        }
+
+    # Bot replies go to the oldest exchange in the chat whose pattern matches them, or
+    # else to the oldest one without a pattern
+    def replied(self, chat_id: int, text: str):
+        waiting = self.pending.get(chat_id)
+        if not waiting:
+            return
+        exchange = next(
+            (e for e in waiting if e.pattern is not None and e.pattern.search(text)),
+            None,
+        )
+        if exchange is None:
+            exchange = next((e for e in waiting if e.pattern is None), None)
+        if exchange is not None and exchange.reply(text):
+            self.forget(exchange)
+
+    def reacted(self, message_id: str, reaction: str):
+        # A reaction to a driver's message (e.g. a cooldown) is the whole reply
+        exchange = self.exchanges.pop(message_id, None)
+        if exchange is not None:
+            exchange.reply(f":{reaction}:", final=True)
+            self.forget(exchange)
+
+    async def websocket(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self.sockets.add(ws)
+        try:
+            async for raw in ws:
+                if raw.type != WSMsgType.TEXT:
+                    continue
+                msg = raw.json()
+                # pyryver waits for an ack to every message it sends, the auth included
+                await ws.send_json(
+                    {
+                        "type": "ack",
+                        "reply_to": msg.get("id"),
+                        "reply_type": msg.get("type"),
+                    }
+                )
+                if msg.get("type") == "auth":
+                    self.connected.set()
+        finally:
+            self.sockets.discard(ws)
+        return ws
+
+    async def api(self, request):
+        path = unquote(request.match_info["path"])
+        match = API_PATH.match(path)
+        obj_type, obj_id, action = match["type"], match["id"], match["action"]
+        obj_id = int(obj_id) if obj_id is not None else None
+        action_name = action.split("(", 1)[0]
+        self.requests[f"{request.method} {obj_type or ''}/{action_name}"] += 1
+
+        body = {}
+        if request.method == "POST" and request.content_type == "application/json":
+            body = await request.json()
+
+        if action_name == "User.Login":
+            return web.json_response(
+                {"d": {"sessionId": "mock", "services": {"chat": self.ws_url}}}
+            )
+        if action_name == "Ryver.Info":
+            return web.json_response(
+                {"d": {"me": {"id": BOT_ID}, "users": [], "forums": [], "teams": []}}
+            )
+        if obj_type in ENTITY_TYPES and obj_id is None and not action:
+            entities = {"users": self.users, "forums": self.forums}.get(obj_type, [])
+            skip = int(request.query.get("$skip", 0))
+            top = int(request.query.get("$top", 50))
+            return web.json_response({"d": {"results": entities[skip : skip + top]}})
+        if action_name == "Chat.PostMessage":
+            message_id = f"m{next(self.message_ids)}"
+            chat = self.by_id.get(obj_id)
+            if chat is None:
+                return web.json_response({}, status=404)
+            self.messages[message_id] = self.message(
+                message_id, chat, body.get("body", ""), BOT_ID
+            )
+            self.replied(obj_id, body.get("body", ""))
+            return web.json_response({"d": {"id": message_id}})
+        if action_name == "Chat.React":
+            message = self.messages.get(str(body.get("id")))
+            if message is None:
+                return web.json_response({}, status=404)
+            message["__reactions"].setdefault(body["reaction"], []).append(BOT_ID)
+            self.reacted(str(body["id"]), body["reaction"])
+            return web.json_response({"d": True})
+        if action_name == "Chat.History.Message":
+            message = self.messages.get(action.split("'")[1])
+            if message is None:
+                return web.json_response({}, status=404)
+            return web.json_response({"d": {"results": [message]}})
+        if action_name == "board":
+            return web.json_response({"d": {"results": {"id": 1, "type": "board"}}})
+        if obj_type == "tasks" and not action:
+            return web.json_response(
+                {
+                    "d": {
+                        "results": {
+                            "id": next(self.message_ids),
+                            "subject": body.get("subject"),
+                        }
+                    }
+                }
+            )
+        if action_name == "UserNotification.Reminder.Create":
+            return web.json_response({"d": {"id": next(self.message_ids)}})
+        if obj_type == "userNotifications" and not action:
+            return web.json_response({"d": {"results": []}})
+        if action_name == "UserNotification.MarkAllRead":
+            return web.json_response({"d": {"count": 0}})
+        if action_name == "Storage.File.Create":
+            await request.read()
+            file_id = next(self.message_ids)
+            return web.json_response(
+                {
+                    "id": file_id,
+                    "recordType": "file",
+                    "file": {
+                        "id": file_id,
+                        "recordType": "file",
+                        "url": f"http://{self.host}:{self.port}/files/{file_id}.png",
+                    },
+                }
+            )
+
+        self.unknown[f"{request.method} {path}"] += 1
+        return web.json_response({"d": {"results": []}})
+
+
+async def serve(args):
+    mock = MockRyver(chats=args.chats, cah_chats=args.cah_chats, users=args.users)
+    await mock.start(args.host, args.port)
+    print("Mock Ryver is running, start the bot with:")
+    print(f"  RYVER_API_URL={mock.api_url}")
+    print(f"  RYVER_ORG=mock RYVER_USER={BOT_USERNAME} RYVER_PASS=mock")
+    print(f"  RYVER_CHAT={mock.chats[0]['id']} BOT_ADMIN={ADMIN_USERNAME}")
+    while True:
+        await sleep(3600)
+
+
+if __name__ == "__main__":
+    from asyncio import run
+
+    parser = ArgumentParser(description="Run a local mock of the Ryver API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--chats", type=int, default=1)
+    parser.add_argument("--cah-chats", type=int, default=0)
+    parser.add_argument("--users", type=int, default=50)
+    try:
+        run(serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
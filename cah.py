@@ -0,0 +1,266 @@
+import json
+from array import array
+from asyncio import Lock
+from itertools import chain
+from random import shuffle
+from sys import intern
+
+# Cards in each player's hand
+HAND_SIZE = 10
+
+
+# Every card in CAH.json, shared by all games. Each card's text is stored once and
+# games only hold card numbers, indexes into the white and black tables.
+class Deck:
+    def __init__(self, path):
+        with open(path, encoding="utf-8") as file:
+            data = json.load(file)[0]
+        self.white = tuple(intern(card["text"]) for card in data["white"])
+        self.black = tuple(intern(card["text"]) for card in data["black"])
+        # Pack name -> numbers of its cards
+        self.white_packs = self.index(data["white"])
+        self.black_packs = self.index(data["black"])
+
+    @staticmethod
+    def index(cards):
+        packs = {}
+        for number, card in enumerate(cards):
+            packs.setdefault(str(card.get("pack", 0)), array("I")).append(number)
+        return packs
+
+    def packs(self):
+        return sorted(set(self.white_packs) | set(self.black_packs))
+
+    def piles(self, packs=None):
+        """Get shuffled white and black piles of the named packs, or every pack."""
+        if packs is None:
+            packs = self.packs()
+        white = chain.from_iterable(self.white_packs.get(pack, ()) for pack in packs)
+        black = chain.from_iterable(self.black_packs.get(pack, ()) for pack in packs)
+        return Piles(white), Piles(black)
+
+
+# A game's draw and discard piles of card numbers
+class Piles:
+    __slots__ = ("draw", "discard")
+
+    def __init__(self, cards=(), discard=()):
+        self.draw = array("I", cards)
+        shuffle(self.draw)
+        self.discard = array("I", discard)
+
+    def __len__(self):
+        return len(self.draw) + len(self.discard)
+
+    def deal(self):
+        """Take the top card, shuffling the discards into a new pile if it ran out."""
+        if not self.draw:
+            if not self.discard:
+                raise IndexError("No cards left to deal")
+            self.draw, self.discard = self.discard, self.draw
+            shuffle(self.draw)
+        return self.draw.pop()
+
+    def to_list(self):
+        return [self.draw.tolist(), self.discard.tolist()]
+
+    @classmethod
+    def from_list(cls, data):
+        piles = cls()
+        piles.draw = array("I", data[0])
+        piles.discard = array("I", data[1])
+        return piles
+
+
+# A player in a Cards Against Humanity game
+class Player:
+    __slots__ = ("name", "points", "cards", "selected_card")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.points = 0
+        # Numbers of the white cards in their hand and of the card they played
+        self.cards = []
+        self.selected_card = None
+
+
+# State of a single Cards Against Humanity game
+class Game:
+    __slots__ = (
+        "chat_id",
+        "packs",
+        "white",
+        "black",
+        "players",
+        "playing",
+        "judge",
+        "black_card",
+        "rounds_left",
+        "running",
+        "waiting_for_join",
+        "selection_time",
+        "waiting_for",
+        "lock",
+    )
+
+    def __init__(self, chat_id: int, rounds: int, deck: Deck, packs=None):
+        self.chat_id = chat_id
+        # Packs the cards come from (every pack if None), and their piles
+        self.packs = packs
+        self.white, self.black = deck.piles(packs)
+        # Everyone in the game and the players (without the judge) in this round, by username
+        self.players = {}
+        self.playing = {}
+        self.judge = None
+        # Number of this round's black card
+        self.black_card = None
+        self.rounds_left = rounds
+        self.running = False
+        self.waiting_for_join = True
+        self.selection_time = False
+        # Number of players in this round that haven't selected a card yet
+        self.waiting_for = 0
+        # Held while a command changes the game so commands don't interleave
+        self.lock = Lock()
+
+    def add_player(self, name: str):
+        player = Player(name)
+        self.players[name] = player
+        return player
+
+    def deal_hands(self):
+        """
+        Deal every player a hand, returning False if there aren't enough white cards for
+        everyone to hold a hand and a played card at once.
+        """
+        if len(self.white) < len(self.players) * (HAND_SIZE + 1) or not self.black:
+            return False
+        for player in self.players.values():
+            player.cards = [self.white.deal() for _ in range(HAND_SIZE)]
+        return True
+
+    def start_round(self, judge: str):
+        """
+        Deal a black card, discard last round's cards and make everyone but the judge
+        play this round.
+        """
+        if self.black_card is not None:
+            self.black.discard.append(self.black_card)
+        self.black_card = self.black.deal()
+        self.selection_time = False
+        self.judge = self.players[judge]
+        self.playing = {}
+        for name, player in self.players.items():
+            if player.selected_card is not None:
+                self.white.discard.append(player.selected_card)
+                player.selected_card = None
+            if name != judge:
+                self.playing[name] = player
+        self.waiting_for = len(self.playing)
+        self.running = True
+        self.rounds_left -= 1
+
+    def play(self, player: Player, index: int):
+        """
+        Play a card from a player's hand and deal them another, returning whether
+        everyone has now selected one. Raises IndexError for cards not in their hand.
+        """
+        if index < 0:
+            raise IndexError(index)
+        card = player.cards.pop(index)
+        if player.selected_card is None:
+            self.waiting_for -= 1
+        else:
+            self.white.discard.append(player.selected_card)
+        player.selected_card = card
+        player.cards.append(self.white.deal())
+        if self.waiting_for == 0:
+            self.selection_time = True
+        return self.selection_time
+
+    def to_dict(self):
+        return {
+            "chat_id": self.chat_id,
+            "packs": self.packs,
+            "white": self.white.to_list(),
+            "black": self.black.to_list(),
+            "players": [
+                [player.name, player.points, player.cards, player.selected_card]
+                for player in self.players.values()
+            ],
+            "playing": list(self.playing),
+            "judge": self.judge.name if self.judge is not None else None,
+            "black_card": self.black_card,
+            "rounds_left": self.rounds_left,
+            "running": self.running,
+            "waiting_for_join": self.waiting_for_join,
+            "selection_time": self.selection_time,
+        }
+
+    @classmethod
+    def from_dict(cls, data, deck: Deck):
+        game = cls(data["chat_id"], data["rounds_left"], deck, data["packs"])
+        game.white = Piles.from_list(data["white"])
+        game.black = Piles.from_list(data["black"])
+        for name, points, cards, selected_card in data["players"]:
+            player = game.add_player(name)
+            player.points = points
+            player.cards = cards
+            player.selected_card = selected_card
+        game.playing = {name: game.players[name] for name in data["playing"]}
+        if data["judge"] is not None:
+            game.judge = game.players[data["judge"]]
+        game.black_card = data["black_card"]
+        game.running = data["running"]
+        game.waiting_for_join = data["waiting_for_join"]
+        game.selection_time = data["selection_time"]
+        game.waiting_for = sum(
+            1 for player in game.playing.values() if player.selected_card is None
+        )
+        return game
+
+    def scores(self, mention: bool = False):
+        prefix = "@" if mention else ""
+        return "".join(
+            f"{prefix}{player.name} : {str(player.points)} \n"
+            for player in self.players.values()
+        )
+
+
+# Games in progress, keyed by the ID of the chat they're played in
+class GameRegistry:
+    def __init__(self, deck: Deck, state=None):
+        self.deck = deck
+        self.games = {}
+        # Optional StateStore the games are saved to, so they survive restarts
+        self.state = state
+        if state is not None:
+            for key, data in state.load("games").items():
+                # Games saved before they had their own piles can't be resumed
+                if "white" not in data:
+                    state.delete("games", key)
+                    continue
+                self.restore(Game.from_dict(data, deck))
+
+    def get(self, chat_id: int):
+        return self.games.get(chat_id)
+
+    def create(self, chat_id: int, rounds: int, packs=None):
+        game = Game(chat_id, rounds, self.deck, packs)
+        self.games[chat_id] = game
+        return game
+
+    def restore(self, game: Game):
+        self.games[game.chat_id] = game
+
+    def save(self, game: Game):
+        if self.state is not None:
+            self.state.put("games", game.chat_id, game.to_dict())
+
+    def end(self, chat_id: int):
+        self.games.pop(chat_id, None)
+        if self.state is not None:
+            self.state.delete("games", chat_id)
+
+    def __len__(self):
+        return len(self.games)
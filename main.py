@@ -1,4 +1,4 @@
-from asyncio import get_event_loop
+from asyncio import TimeoutError, create_task, gather, get_event_loop
 from configparser import ConfigParser
 from datetime import datetime, timedelta
 from os import getenv, system, path
@@ -9,37 +9,56 @@ from urllib.parse import quote
 
 from dotenv import load_dotenv
 from git import Repo
-from googletrans import Translator
 from phonetic_alphabet import read as phonetics
 from phonetic_alphabet.main import NonSupportedTextException
-from py_expression_eval import Parser
 from pyryver import Ryver, RyverWS
-from pyryver.objects import Notification, TaskBoard
+from pyryver.objects import TaskBoard
 from pyryver.util import datetime_to_iso8601, retry_until_available
 from pyryver.ws_data import WSEventData
 from pytz import timezone
 
+import metrics
+from cah import Deck, GameRegistry
+from trivia import TriviaSessions
+from state import StateStore
 from utils import (
-    Cooldown,
+    MW_DICTIONARY_URL,
+    MW_THESAURUS_URL,
+    CardCache,
+    CommandRegistry,
+    ExpressionSandbox,
+    RateLimits,
+    TRANSLATION_BACKENDS,
+    TimerScheduler,
     TopicGenerator,
+    TranslationService,
+    TriviaBank,
+    TriviaPack,
+    IdentityCache,
+    LookupCache,
+    MessageCache,
+    MessageScheduler,
+    NotificationPipeline,
+    PollTally,
+    Profiler,
+    WebClient,
+    WebLookupError,
     bot_dir,
     console,
+    fetch_poll_tally,
     handle_notification,
+    lookup_word,
+    parse_definition,
+    parse_synonyms,
     remind_task,
     send_message,
+    show_poll_results,
     ImageGenerator
 )
 from pyryver.util import retry_until_available
-import urllib.request
-import urllib
-import requests
-import urllib.request
-from bs4 import BeautifulSoup
 import re
 import random
 
-import json
-
 __version__ = "1.4.1"
 
 load_dotenv(
@@ -47,16 +66,28 @@ load_dotenv(
 )  # Added path to support older versions of python-dotenv
 
 config = ConfigParser()
-config.read("brainbot.ini")
-
-tell_me_to_cooldown = Cooldown(config.getint("cooldowns", "tell_me_to", fallback=200))
-topic_cooldown = Cooldown(config.getint("cooldowns", "topic", fallback=100))
-repeat_cooldown = Cooldown(config.getint("cooldowns", "repeat", fallback=45))
-phon_cooldown = Cooldown(config.getint("cooldowns", "phon", fallback=45))
-poll_cooldown = Cooldown(config.getint("cooldowns", "poll", fallback=100))
-trivia_cooldown=Cooldown(config.getint("cooldowns", "trivia", fallback=30))
-define_cooldown = Cooldown(config.getint("cooldowns", "define", fallback=45))
-synonyms_cooldown = Cooldown(config.getint("cooldowns", "synonyms", fallback=45))
+# BRAINBOT_CONFIG points at another config, e.g. the one benchmark/load.py writes
+config.read(getenv("BRAINBOT_CONFIG", "brainbot.ini"))
+
+rate_limits = RateLimits(
+    config,
+    path=(
+        bot_dir / "ratelimits.json"
+        if config.getboolean("misc", "save_rate_limits", fallback=False)
+        else None
+    ),
+)
+tell_me_to_cooldown = rate_limits.get("tell_me_to", fallback=200)
+topic_cooldown = rate_limits.get("topic", fallback=100)
+repeat_cooldown = rate_limits.get("repeat", fallback=45)
+phon_cooldown = rate_limits.get("phon", fallback=45)
+poll_cooldown = rate_limits.get("poll", fallback=100)
+trivia_cooldown = rate_limits.get("trivia", fallback=30)
+define_cooldown = rate_limits.get("define", fallback=45)
+synonyms_cooldown = rate_limits.get("synonyms", fallback=45)
+rate_limits.load()
+# Whether timed polls are closed by a local timer or by Ryver task reminders
+poll_timer = config.get("misc", "poll_timer", fallback="local")
 # Load poll reactions
 poll_reactions = config.get(
     "misc",
@@ -64,21 +95,111 @@ poll_reactions = config.get(
     fallback="zero;one;two;three;four;five;six;seven;eight;nine;keycap_ten",
 ).split(";")
 
-math_parser = Parser()
-topic_engine = TopicGenerator()
-translator = Translator()
-
-cah = json.load(open('CAH.json'))[0]
-game = {
-    'running': False,
-    'waitingForJoin': False,
-    'readCommands': False,
-    'players': [],
-    'playing': [],
-    'roundsLeft': 2,
-    'selectionTime': False,
-    'cardQueen': '' #username of card queen
-}
+POLL_USAGE = """
+Command usage:  !poll [t=due_time;]<poll_title>;<option1>;<option2>...
+                !poll [d=due_date;]<poll_title>;<option1>;<option2>...
+                !poll [m=minutes;]<poll_title>;<option1>;<option2>...
+                [] = Optional <> = Mandatory
+Time should use the following format:   t=HH:MM
+                                        d=mm/dd/yyyy HH:MM
+                                        m=<minutes>
+    Time options d= ,t= and d= are not compatible.
+    In case of using more than one of them only the first one will be used, while the other
+    will be considered the rest of the arguments.
+    Bot timezone will be used.
+
+Poll maximum option number depends of the amount of reactions in the config file
+setting 'misc:poll_reactions'.
+
+If due date/time is entered the bot will post the poll results at that time.
+"""
+
+evaluator = ExpressionSandbox(
+    workers=config.getint("evaluate", "workers", fallback=2),
+    timeout=config.getfloat("evaluate", "timeout", fallback=2.0),
+    cpu_seconds=config.getint("evaluate", "cpu_seconds", fallback=2),
+    memory=config.getint("evaluate", "memory_mb", fallback=128) * 1024 * 1024,
+    cache_size=config.getint("evaluate", "cached_expressions", fallback=256),
+    table_points=config.getint("evaluate", "table_points", fallback=100000),
+    table_rows=config.getint("evaluate", "table_rows", fallback=20),
+)
+trivia_path = bot_dir / config.get("trivia", "bank", fallback="TriviaQuestions.txt")
+# Compiled packs are mapped, anything else is read as "question,answer" lines
+trivia_bank = (
+    TriviaPack(trivia_path) if trivia_path.suffix == ".tpk" else TriviaBank(trivia_path)
+)
+translator = TranslationService(
+    TRANSLATION_BACKENDS[config.get("translate", "backend", fallback="google")],
+    workers=config.getint("translate", "workers", fallback=4),
+    timeout=config.getfloat("translate", "timeout", fallback=10.0),
+    ttl=config.getfloat("translate", "ttl", fallback=24 * 60 * 60),
+    size=config.getint("translate", "size", fallback=512),
+)
+web_client = WebClient(
+    limit=config.getint("web", "connections", fallback=20),
+    limit_per_host=config.getint("web", "connections_per_host", fallback=4),
+    connect_timeout=config.getfloat("web", "connect_timeout", fallback=5.0),
+    read_timeout=config.getfloat("web", "read_timeout", fallback=10.0),
+    max_size=config.getint("web", "max_response_size", fallback=2 * 1024 * 1024),
+)
+image_generator = ImageGenerator(
+    workers=config.getint("cah", "render_workers", fallback=1)
+)
+card_cache = CardCache(
+    image_generator, max_files=config.getint("cah", "cached_cards", fallback=512)
+)
+outbox = MessageScheduler(
+    concurrency=config.getint("messages", "concurrency", fallback=4),
+    max_queued=config.getint("messages", "max_queued", fallback=256),
+)
+profiler = Profiler(
+    top=config.getint("profile", "top", fallback=40),
+    max_seconds=config.getint("profile", "max_seconds", fallback=300),
+)
+lookup_cache = LookupCache(
+    ttl=config.getfloat("lookup_cache", "ttl", fallback=7 * 24 * 60 * 60),
+    negative_ttl=config.getfloat("lookup_cache", "negative_ttl", fallback=60 * 60),
+    size=config.getint("lookup_cache", "size", fallback=512),
+)
+
+deck = Deck(bot_dir / "CAH.json")
+state = StateStore()
+games = GameRegistry(deck, state)
+topic_engine = TopicGenerator(
+    [
+        pattern.strip()
+        for pattern in config.get("topics", "packs", fallback="topics.txt").split(",")
+        if pattern.strip()
+    ],
+    state,
+)
+# Polls waiting for their results, by poll message ID
+pending_polls = state.load("polls")
+# Live vote counts of pending polls and of the latest poll in each chat, by poll message ID
+poll_tallies = {}
+# ID of the latest poll in each chat, by chat ID
+latest_polls = {}
+trivia_sessions = TriviaSessions(
+    state, timeout=config.getfloat("trivia", "timeout", fallback=300)
+)
+
+
+# Drop a poll that has shown its results
+def forget_poll(poll_id):
+    if poll_id is None:
+        return
+    poll_id = str(poll_id)
+    poll_tallies.pop(poll_id, None)
+    if pending_polls.pop(poll_id, None) is not None:
+        state.delete("polls", poll_id)
+
+
+# Save a pending poll along with its current votes
+def save_poll(poll_id: str):
+    poll = pending_polls[poll_id]
+    poll["votes"] = poll_tallies[poll_id].to_dict()
+    state.put("polls", poll_id, poll)
+
 
 # Wrap in async function to use async context manager
 async def main():
@@ -86,6 +207,23 @@ async def main():
     async with Ryver(
         getenv("RYVER_ORG"), getenv("RYVER_USER"), getenv("RYVER_PASS")
     ) as ryver:
+        # Talk to another API server instead, e.g. the benchmark's mock Ryver
+        if getenv("RYVER_API_URL"):
+            ryver._url_prefix = getenv("RYVER_API_URL")
+        metrics.instrument(ryver._session)
+
+        # Serve metrics for Prometheus to scrape if a port is set
+        metrics_server = None
+        if config.getint("metrics", "port", fallback=0):
+            metrics_server = await metrics.serve(
+                config.get("metrics", "host", fallback="127.0.0.1"),
+                config.getint("metrics", "port"),
+            )
+            create_task(
+                metrics.sample_loop_lag(
+                    config.getfloat("metrics", "lag_interval", fallback=1.0)
+                )
+            )
         console.log(
             f"Connected to {getenv('RYVER_ORG')} Ryver org as user {getenv('RYVER_USER')}"
         )
@@ -94,15 +232,24 @@ async def main():
         await ryver.load_chats()
         console.log(f"Loaded {getenv('RYVER_ORG')} chats")
 
-        bot_chat = ryver.get_chat(id=int(getenv("RYVER_CHAT")))
+        identities = IdentityCache(
+            ryver, ttl=config.getfloat("misc", "identity_ttl", fallback=60 * 60)
+        )
+        bot_chat = identities.chat(int(getenv("RYVER_CHAT")))
+
+        # Remember recent messages so reactions don't have to fetch them first
+        messages = MessageCache(
+            ryver, size=config.getint("misc", "message_cache_size", fallback=1024)
+        )
+        outbox.on_sent = messages.add
 
         # Get bot admins for restricted commands
         bot_admins = [
-            ryver.get_user(username=user) for user in getenv("BOT_ADMIN").split(",")
+            identities.user(username=user) for user in getenv("BOT_ADMIN").split(",")
         ]
 
         # Get bot user for task and timezone consults
-        bot_user = ryver.get_user(id=(await ryver.get_info())["me"]["id"])
+        bot_user = identities.user(id=(await identities.get_info())["me"]["id"])
 
         # Get bot task board (used for setting timers)
         bot_task_board = await bot_user.get_task_board()
@@ -120,891 +267,1007 @@ async def main():
             )
         )
 
-        # Handle unread notifications from last session (used for checking reminders)
-        async for notification in ryver.get_notifs(unread=True):
-            await handle_notification(
-                ryver=ryver, notification=notification, bot_chat=bot_chat
+        # Rebuild the live tallies of polls from the last session
+        for poll_id, poll in pending_polls.items():
+            poll_tallies[poll_id] = PollTally(
+                poll["inputs"], poll["reactions"], bot_user.get_id(), poll.get("votes")
+            )
+            latest_polls[poll["chat_id"]] = poll_id
+
+        # Get the chat a poll was posted in, polls saved without one are in the main chat
+        def poll_chat(poll_id):
+            chat_id = pending_polls.get(poll_id, {}).get("chat_id")
+            chat = identities.chat(chat_id) if chat_id is not None else None
+            return chat or bot_chat
+
+        # Handle a relevant notification (used for checking reminders)
+        async def _on_notification(notification):
+            forget_poll(
+                await handle_notification(
+                    ryver=ryver,
+                    notification=notification,
+                    bot_chat=bot_chat,
+                    tallies=poll_tallies,
+                    bot_id=bot_user.get_id(),
+                    poll_chat=poll_chat,
+                )
             )
 
-        async with ryver.get_live_session() as session:
-            console.log("In live session")
-
-            @session.on_chat
-
-            async def _on_chat(msg):
-                # Stop if message wasn't sent to the bot chat
-                if msg.to_jid != bot_chat.get_jid():
-                    return
-
-                # Get the user that sent the message
-                user = ryver.get_user(jid=msg.from_jid)
-
-                # Bypass the cooldown on the !topic command
-                if msg.text.lower().startswith("!topic bypass"):
-                    if user in bot_admins:
-                        console.log(
-                            f"{user.get_username()} used the !topic command [bold red](COOLDOWN BYPASS)"
-                        )
-
-                        topic_cooldown.run(bypass=True)
-
-                        await send_message(
-                            f"++**Conversation starter:**++\n{topic_engine.topic()}",
-                            bot_chat,
-                        )
-
-                    else:
-                        console.log(
-                            f"[bold red]{user.get_username()} attempted to bypass the topic cooldown"
-                        )
-                
-                # Get a conversation starter
-                elif msg.text.lower().startswith("!topic"):
-                    console.log(f"{user.get_username()} used the !topic command")
-
-                    if topic_cooldown.run():
-                        await send_message(
-                            f"++**Conversation starter:**++\n{topic_engine.topic()}",
-                            bot_chat,
-                        )
-                    else:
-                        console.log("Cancelled due to cooldown")
-
-                        # Get the invoking message
-                        message = await retry_until_available(
-                            bot_chat.get_message,
-                            msg.message_id,
-                            timeout=5.0,
-                            retry_delay=0.5,
-                        )
-
-                        # React to show the command is on cooldown
-                        await message.react("timer_clock")
-                # "Someone tell me to" autoresponse
-                elif msg.text.lower().startswith("someone tell me to "):
-                    to_do = msg.text[19:]
-                    console.log(f"Telling {user.get_username()} to {to_do}")
-                    if tell_me_to_cooldown.run(username=user.get_username()):
-                        await send_message(f"@{user.get_username()}: {to_do}", bot_chat)
-                    else:
-                        console.log("Cancelled due to cooldown")
-                
-                # Repeat after the user
-                elif msg.text.lower().startswith("!repeat"):
-                    msg_text = msg.text[8:]
-                    updatedmsg_text = msg_text.replace("!","\!")
-                    console.log(f"Repeating {user.get_username()}")
-                    if repeat_cooldown.run(username=user.get_username()):
-                        await send_message(
-                            f"{updatedmsg_text}",
-                            bot_chat,
-                            footer_end=f"This command was run by {user.get_username()}.",
-                        )
-                    else:
-                        console.log("Cancelled due to cooldown")
-                # Give the current version
-                elif msg.text.lower().startswith("!version"):
-                    console.log(f"Telling {user.get_username()} the current version")
-                    await send_message(f"BrainBot v{__version__}", bot_chat)
-                # Translate a given word or phrase
-                elif msg.text.lower().startswith("!translate"):
-                    console.log(f"Translating for {user.get_username()}")
-                    language = msg.text[11:13]
-                    word = msg.text[14:]
-
-                    translation = translator.translate(word, dest=language)
-
-                    await send_message(
-                        f"++**Translation result:**++\n{translation.text}",
-                        bot_chat,
-                        footer_end=f"This command was run by {user.get_username()}.",
-                    )
-                # Give an introduction of the bot
-                elif msg.text.lower().startswith("!intro"):
-                    console.log(f"Telling {user.get_username()} who I am")
-                    await send_message(
-                        "Hi! I'm BrainBot. I'm a fun, engagement-increasing bot made by the open-source community. Ask me for a list of commands if you'd like by saying `!commands`.",
-                        bot_chat,
-                    )
-                # Evaluate a math expression
-                elif msg.text.lower().startswith("!evaluate"):
-                    inputs = [value.strip() for value in msg.text[10:].split(";")]
-                    console.log(
-                        f"Evaluating {'; '.join(inputs)} for {user.get_username()}"
-                    )
-                    try:
-                        expression = math_parser.parse(inputs[0])
-                    except:
-                        console.log("[red]An error occurred during parsing")
-                        await send_message(
-                            "An error occurred while trying to parse your input.",
-                            bot_chat,
-                        )
-                        return
+        notifications = NotificationPipeline(
+            ryver,
+            _on_notification,
+            concurrency=config.getint("misc", "notification_concurrency", fallback=8),
+        )
+        console.log(f"Rehydrated {len(games)} CAH games and {len(pending_polls)} polls")
+
+        # Save state changes in batches
+        create_task(state.autoflush())
+
+        # Catch up on votes cast while the bot was offline
+        async def resync_poll(poll_id):
+            chat = identities.chat(pending_polls[poll_id]["chat_id"])
+            try:
+                message = await retry_until_available(
+                    chat.get_message,
+                    poll_id,
+                    timeout=5.0,
+                    retry_delay=0.5,
+                )
+            except TimeoutError:
+                console.log(f"[red]Failed to retrieve poll {poll_id} to resync votes")
+                return
+            if poll_id in poll_tallies:
+                poll_tallies[poll_id].resync(message.get_reactions())
+                save_poll(poll_id)
+
+        for poll_id in pending_polls:
+            create_task(resync_poll(poll_id))
+
+        # Show a poll's results once its timer is up
+        async def finish_poll(poll_id):
+            poll = pending_polls.get(poll_id)
+            if poll is None:
+                return
+            console.log(f"Poll {poll_id} has ended")
+            chat = identities.chat(poll["chat_id"])
+            tally = poll_tallies.get(poll_id)
+            if tally is None:
+                tally = await fetch_poll_tally(
+                    chat, poll["inputs"], poll["reactions"], poll_id, bot_user.get_id()
+                )
+            if tally is not None:
+                await show_poll_results(chat, tally)
+            forget_poll(poll_id)
+
+        poll_scheduler = TimerScheduler(finish_poll)
+        for poll_id, poll in pending_polls.items():
+            if poll.get("timer") == "local":
+                poll_scheduler.schedule(poll_id, poll["due"])
+        create_task(poll_scheduler.run())
+
+        # Pre-render the black deck in the background if enabled
+        if config.getboolean("cah", "warm_up", fallback=False):
+            create_task(card_cache.warm_up(deck.black))
+
+        # Periodically save rate limits so a restart doesn't reset them
+        create_task(rate_limits.autosave())
+
+        commands = CommandRegistry(identities, admins=bot_admins)
+
+        # React to commands rejected by their cooldown
+        @commands.on_cooldown
+        async def _on_cooldown(ctx):
+            # React to show the command is on cooldown
+            await messages.react(ctx.msg.message_id, "timer_clock", ctx.chat)
+
+        # Get a conversation starter
+        @commands.command("!topic", cooldown=topic_cooldown, bypass=True, react=True)
+        async def _topic(ctx):
+            console.log(f"{ctx.username} used the !topic command")
+            try:
+                topic = topic_engine.topic(ctx.args or None)
+            except KeyError:
+                await outbox.send(
+                    "I don't have topics about that, try one of: "
+                    + ", ".join(topic_engine.filter_names()),
+                    ctx.chat,
+                )
+                return
+            if topic is None:
+                await outbox.send("I don't have any topics right now.", ctx.chat)
+                return
+            await outbox.send(f"++**Conversation starter:**++\n{topic}", ctx.chat)
+
+        # "Someone tell me to" autoresponse
+        @commands.command(
+            "someone tell me to", cooldown=tell_me_to_cooldown, per_user=True
+        )
+        async def _tell_me_to(ctx):
+            console.log(f"Telling {ctx.username} to {ctx.args}")
+            await outbox.send(f"@{ctx.username}: {ctx.args}", ctx.chat)
+
+        # Repeat after the user
+        @commands.command("!repeat", cooldown=repeat_cooldown, per_user=True)
+        async def _repeat(ctx):
+            updatedmsg_text = ctx.args.replace("!", "\!")
+            console.log(f"Repeating {ctx.username}")
+            await outbox.send(
+                f"{updatedmsg_text}",
+                ctx.chat,
+                footer_end=f"This command was run by {ctx.username}.",
+            )
 
-                    variables = expression.variables()
-                    if len(inputs) - 1 != len(variables):
-                        console.log("[red]Incorrect number of variables provided")
-                        await send_message(
-                            f"You have not provided the correct number of variables. (Expected {len(variables)})",
-                            bot_chat,
-                        )
-                        return
+        # Give the current version
+        @commands.command("!version")
+        async def _version(ctx):
+            console.log(f"Telling {ctx.username} the current version")
+            await outbox.send(f"BrainBot v{__version__}", ctx.chat)
 
-                    values = dict(
-                        zip(variables, [float(value) for value in inputs[1:]])
-                    )
+        # Translate a given word or phrase
+        @commands.command(
+            "!translate", usage="Command usage: `!translate <language code> <text>`"
+        )
+        async def _translate(ctx):
+            console.log(f"Translating for {ctx.username}")
+            language = ctx.args[:2]
+            word = ctx.args[3:]
+
+            try:
+                translation = await translator.translate(word, language)
+            except TimeoutError:
+                await outbox.send(
+                    "The translation took too long, try again later.", ctx.chat
+                )
+                return
+            except Exception as e:
+                console.log(f"[red]Translation failed: {e!r}")
+                await outbox.send("I couldn't translate that.", ctx.chat)
+                return
+
+            await outbox.send(
+                f"++**Translation result:**++\n{translation}",
+                ctx.chat,
+                footer_end=f"This command was run by {ctx.username}.",
+            )
 
-                    try:
-                        result = expression.evaluate(values)
-                    except:
-                        console.log("[red]An error occurred during evaluation")
-                        await send_message(
-                            "An error occurred while trying to evaluate your input.",
-                            bot_chat,
-                        )
-                        return
+        # Give an introduction of the bot
+        @commands.command("!intro")
+        async def _intro(ctx):
+            console.log(f"Telling {ctx.username} who I am")
+            await outbox.send(
+                "Hi! I'm BrainBot. I'm a fun, engagement-increasing bot made by the open-source community. Ask me for a list of commands if you'd like by saying `!commands`.",
+                ctx.chat,
+            )
 
-                    await send_message(
-                        f"++**Evaluation result:**++\n{result}", bot_chat
-                    )
-                # Give phonetic spellings
-                elif msg.text.lower().startswith("!phon"):
-                    console.log(f"Giving a phonetic spelling for {user.get_username()}")
-                    # Check length to ensure a value is there
-                    if phon_cooldown.run(username=user.get_username()):
-                        if len(msg.text) <= 6:
-                            await send_message(
-                                "Please enter a word or phrase to be converted",
-                                bot_chat,
-                            )
-                            return
-
-                        try:
-                            result = phonetics(msg.text.lower()[6:])
-                        except NonSupportedTextException:
-                            await send_message(
-                                "Your text contained one or more unsupported characters",
-                                bot_chat,
-                            )
-                            return
-
-                        await send_message(
-                            f"++**Phonetic characters:**++\n{result}", bot_chat
+        # Evaluate a math expression
+        @commands.command("!evaluate")
+        async def _evaluate(ctx):
+            inputs = [value.strip() for value in ctx.args.split(";")]
+            console.log(f"Evaluating {'; '.join(inputs)} for {ctx.username}")
+            # Named values like x=0..100 step 5 or y=1,2,3 evaluate a whole table at once
+            if any("=" in value for value in inputs[1:]):
+                status, result = await evaluator.table(inputs[0], inputs[1:])
+            else:
+                status, result = await evaluator.evaluate(inputs[0], inputs[1:])
+            if status == "parse_error":
+                console.log("[red]An error occurred during parsing")
+                await outbox.send(
+                    "An error occurred while trying to parse your input.",
+                    ctx.chat,
+                )
+                return
+
+            if status == "variables":
+                console.log("[red]Incorrect number of variables provided")
+                await outbox.send(
+                    f"You have not provided the correct number of variables. (Expected {result})",
+                    ctx.chat,
+                )
+                return
+
+            if status == "missing":
+                await outbox.send(
+                    f"Please give values for every variable: {result}", ctx.chat
+                )
+                return
+
+            if status == "range_error":
+                await outbox.send(
+                    f"I couldn't read `{result}`, use values like `x=0..100 step 5` or `x=1,2,3`.",
+                    ctx.chat,
+                )
+                return
+
+            if status == "too_many":
+                await outbox.send(
+                    f"That's more than {result} points, try a bigger step or fewer values.",
+                    ctx.chat,
+                )
+                return
+
+            if status == "limit":
+                console.log("[red]Evaluation went over its time or memory limit")
+                await outbox.send(
+                    "Your input took too long or too much memory to evaluate.",
+                    ctx.chat,
+                )
+                return
+
+            if status == "eval_error":
+                console.log("[red]An error occurred during evaluation")
+                await outbox.send(
+                    "An error occurred while trying to evaluate your input.",
+                    ctx.chat,
+                )
+                return
+
+            if status == "table":
+                rows, table, csv = result
+                if table is not None:
+                    await outbox.send(f"++**Evaluation results:**++\n{table}", ctx.chat)
+                    return
+                # Big tables are sent as a file instead of flooding the chat
+                upload = await ryver.upload_file(
+                    "evaluation.csv", csv.encode(), "text/csv"
+                )
+                await send_message(
+                    f"++**Evaluation results:**++\n{rows} rows are in the attached file.",
+                    ctx.chat,
+                    attachment=upload,
+                    from_user=bot_user,
+                )
+                return
+
+            await outbox.send(f"++**Evaluation result:**++\n{result}", ctx.chat)
+
+        # Give phonetic spellings
+        @commands.command("!phon", cooldown=phon_cooldown, per_user=True)
+        async def _phon(ctx):
+            console.log(f"Giving a phonetic spelling for {ctx.username}")
+            # Check length to ensure a value is there
+            if not ctx.args:
+                await outbox.send(
+                    "Please enter a word or phrase to be converted",
+                    ctx.chat,
+                )
+                return
+
+            try:
+                result = phonetics(ctx.args.lower())
+            except NonSupportedTextException:
+                await outbox.send(
+                    "Your text contained one or more unsupported characters",
+                    ctx.chat,
+                )
+                return
+
+            await outbox.send(f"++**Phonetic characters:**++\n{result}", ctx.chat)
+
+        # Random Emoticon
+        @commands.command("!emoticon")
+        async def _emoticon(ctx):
+            emoticons = [
+                "`( ͡❛ ͜ʖ ͡❛)`",
+                "`O_o`",
+                "`（　0ゝ0 )`",
+                "`(╯°□°）╯︵ ┻━┻`",
+                "`:-)`",
+                "`<(o_o<)`",
+                "`(/^▽^)/`",
+                "`〠_〠`",
+                "`(￢‿￢ )`",
+                "`ᕕ( ᐛ )ᕗ`",
+            ]
+            console.log(f"Giving {ctx.username} a random emoticon.")
+            await outbox.send(choice(emoticons), ctx.chat)
+
+        # Create Poll
+        @commands.command(
+            "!poll",
+            cooldown=poll_cooldown,
+            per_user=True,
+            react=True,
+            usage=POLL_USAGE,
+        )
+        async def _poll(ctx):
+            # Get potential arguments
+            inputs = [value.strip() for value in ctx.args.split(";")]
+
+            # Remove any empty arguments
+            while "" in inputs:
+                inputs.remove("")
+
+            # Check if the command contains due date argument
+            due_date = None
+            if inputs[0].startswith("t="):
+                try:
+                    # Parse ending time
+                    due_date = inputs[0][2:]
+                    due_date = datetime.strptime(due_date, "%H:%M")
+                    # Get current time at bot timezone
+                    current_date = datetime.now(timezone(bot_user.get_time_zone()))
+
+                    # If entered hour is earlier (or equal) than the current time, set date due for the next day
+                    if current_date.time() >= due_date.time():
+                        due_date = datetime.combine(
+                            current_date.today() + timedelta(days=1),
+                            due_date.time(),
                         )
                     else:
-                        console.log("Cancelled due to cooldown")
-                # Random Emoticon
-                elif msg.text.lower().startswith("!emoticon"):
-                    emoticons = [
-                        "`( ͡❛ ͜ʖ ͡❛)`",
-                        "`O_o`",
-                        "`（　0ゝ0 )`",
-                        "`(╯°□°）╯︵ ┻━┻`",
-                        "`:-)`",
-                        "`<(o_o<)`",
-                        "`(/^▽^)/`",
-                        "`〠_〠`",
-                        "`(￢‿￢ )`",
-                        "`ᕕ( ᐛ )ᕗ`",
-                    ]
-                    console.log(f"Giving {user.get_username()} a random emoticon.")
-                    await send_message(choice(emoticons), bot_chat)
-                # Create Poll
-                elif msg.text.lower()==("!poll"):
-                    await send_message(f"""
-                    Command usage:  !poll [t=due_time;]<poll_title>;<option1>;<option2>...
-                                    !poll [d=due_date;]<poll_title>;<option1>;<option2>...
-                                    !poll [m=minutes;]<poll_title>;<option1>;<option2>...
-                                    [] = Optional <> = Mandatory
-                    Time should use the following format:   t=HH:MM
-                                                            d=mm/dd/yyyy HH:MM
-                                                            m=<minutes>
-                        Time options d= ,t= and d= are not compatible.
-                        In case of using more than one of them only the first one will be used, while the other
-                        will be considered the rest of the arguments.
-                        Bot timezone will be used.
-
-                    Poll maximum option number depends of the amount of reactions in the config file
-                    setting 'misc:poll_reactions'.
-
-                    If due date/time is entered a task and a reminder will be created inside bot's personal
-                    task board in order to make ryver take care of timers instead of the bot itself.
-                    """,bot_chat)
-                elif msg.text.lower().startswith("!poll"):
-                    if poll_cooldown.run(username=user.get_username()):
-                        # Get potential arguments
-                        inputs = [value.strip() for value in msg.text[6:].split(";")]
-
-                        # Remove any empty arguments
-                        while "" in inputs:
-                            inputs.remove("")
-
-                        # Check if the command contains due date argument
-                        due_date = None
-                        if inputs[0].startswith("t="):
-                            try:
-                                # Parse ending time
-                                due_date = inputs[0][2:]
-                                due_date = datetime.strptime(due_date, "%H:%M")
-                                # Get current time at bot timezone
-                                current_date = datetime.now(
-                                    timezone(bot_user.get_time_zone())
-                                )
-
-                                # If entered hour is earlier (or equal) than the current time, set date due for the next day
-                                if current_date.time() >= due_date.time():
-                                    due_date = datetime.combine(
-                                        current_date.today() + timedelta(days=1),
-                                        due_date.time(),
-                                    )
-                                else:
-                                    due_date = datetime.combine(
-                                        current_date.today(),
-                                        due_date.time(),
-                                    )
-
-                                # Set date's timezone
-                                due_date = due_date.astimezone(
-                                    timezone(bot_user.get_time_zone())
-                                )
-                                inputs.pop(0)
-                            except ValueError:
-                                due_date = False
-
-                        if inputs[0].startswith("d="):
-                            try:
-                                # Parse full ending date
-                                due_date = inputs[0][2:]
-                                due_date = datetime.strptime(due_date, "%m/%d/%Y %H:%M")
-                                due_date = due_date.astimezone(
-                                    timezone(bot_user.get_time_zone())
-                                )
-                                inputs.pop(0)
-                            except ValueError:
-                                due_date = False
-
-                        if inputs[0].startswith("m="):
-                            try:
-                                due_date = int(inputs[0][2:])
-                                # Get current time at bot timezone
-                                current_date = datetime.now(
-                                    timezone(bot_user.get_time_zone())
-                                )
-                                due_date = current_date.replace(
-                                    microsecond=0
-                                ) + timedelta(minutes=due_date, seconds=1)
-                                inputs.pop(0)
-                            except ValueError:
-                                due_date = False
-
-                        if due_date is None or due_date is not False:
-                            current_date = datetime.now(
-                                timezone(bot_user.get_time_zone())
-                            )
-
-                            # In case of valid due time, check if it's already in the past
-                            if (
-                                due_date is None
-                                or int((due_date - current_date).total_seconds() / 60)
-                                > 0
-                            ):
-
-                                # Check if the command contains a valid number of arguments
-                                if len(inputs) < 3:
-                                    await send_message(
-                                        "Please enter a question and at least two options to create a poll",
-                                        bot_chat,
-                                    )
-                                elif len(inputs) > (len(poll_reactions) + 1):
-                                    await send_message(
-                                        f"Your poll contained too many options, limit is {len(poll_reactions)} options",
-                                        bot_chat,
-                                    )
-                                else:
-                                    console.log(
-                                        f'Creating poll "{inputs[0]}" for {user.get_username()}'
-                                    )
-
-                                    # Create formatted poll text
-                                    poll_txt = "# {0}\n".format(inputs[0])
-                                    for i in range(1, len(inputs)):
-                                        poll_txt += ":{0}: {1}\n".format(
-                                            poll_reactions[i - 1], inputs[i]
-                                        )
-
-                                    if due_date is not None:
-                                        poll_txt += "\n\n**Poll will end on {0} at {1} ({2})**".format(
-                                            due_date.date(),
-                                            due_date.time(),
-                                            due_date.tzname(),
-                                        )
-                                    poll_id = await send_message(
-                                        poll_txt,
-                                        bot_chat,
-                                        f"This poll was created by {user.get_username()}",
-                                    )
-
-                                    # Get the poll message
-                                    message = await retry_until_available(
-                                        bot_chat.get_message,
-                                        poll_id,
-                                        timeout=5.0,
-                                        retry_delay=0.5,
-                                    )
-
-                                    # Add reaction options
-                                    for i in range(0, (len(inputs)) - 1):
-                                        await message.react(poll_reactions[i])
-
-                                    # Set ending timer using tasks
-                                    if due_date is not None:
-                                        task_body = "{0}".format(inputs[0])
-                                        # Add options to task message for later parsing
-                                        for i in inputs[1:]:
-                                            task_body += ";{0}".format(i)
-                                        # Add reactions used for later parsing
-                                        task_body += ";"
-                                        for i in poll_reactions[: (len(inputs) - 1)]:
-                                            task_body += ";{0}".format(i)
-                                        poll_task = await bot_task_board.create_task(
-                                            f"BrainBotPoll#{poll_id}",
-                                            task_body,
-                                            due_date=datetime_to_iso8601(due_date),
-                                        )
-                                        # Create task reminder
-                                        await remind_task(
-                                            ryver,
-                                            poll_task,
-                                            int(
-                                                (
-                                                    due_date - current_date
-                                                ).total_seconds()
-                                                / 60
-                                            ),
-                                        )
-                            else:
-                                await send_message(
-                                    "Ending time entered is already in the past or too short",
-                                    bot_chat,
-                                )
-                        else:
-                            await send_message(
-                                "Ending time entered is not valid. You can any of these formats:\n `t=hh:mm;`\n `d=mm/dd/yyyy hh:mm;`\n`m=<minutes>;`\n**~Don't~ ~forget~ ~to~ ~use~ ~';'!~**",
-                                bot_chat,
-                            )
-                    else:
-                        console.log("Cancelled due to cooldown")
-
-                        # Get the invoking message
-                        message = await retry_until_available(
-                            bot_chat.get_message,
-                            msg.message_id,
-                            timeout=5.0,
-                            retry_delay=0.5,
+                        due_date = datetime.combine(
+                            current_date.today(),
+                            due_date.time(),
                         )
 
-                        # React to show the command is on cooldown
-                        await message.react("timer_clock")
-                # Give a list of commands
-                elif msg.text.lower().startswith("!commands"):
-                    console.log(f"Telling {user.get_username()} my commands")
-                    await send_message(
-                        "Check out [my wiki](https://github.com/brainbotdev/brainbot/wiki) to learn what commands I understand.",
-                        bot_chat,
+                    # Set date's timezone
+                    due_date = due_date.astimezone(timezone(bot_user.get_time_zone()))
+                    inputs.pop(0)
+                except ValueError:
+                    due_date = False
+
+            if inputs[0].startswith("d="):
+                try:
+                    # Parse full ending date
+                    due_date = inputs[0][2:]
+                    due_date = datetime.strptime(due_date, "%m/%d/%Y %H:%M")
+                    due_date = due_date.astimezone(timezone(bot_user.get_time_zone()))
+                    inputs.pop(0)
+                except ValueError:
+                    due_date = False
+
+            if inputs[0].startswith("m="):
+                try:
+                    due_date = int(inputs[0][2:])
+                    # Get current time at bot timezone
+                    current_date = datetime.now(timezone(bot_user.get_time_zone()))
+                    due_date = current_date.replace(microsecond=0) + timedelta(
+                        minutes=due_date, seconds=1
                     )
-                # Pull the latest changes from GitHub
-                elif msg.text.lower().startswith("!pull"):
-                    if user in bot_admins:
-                        try:
-                            Repo(bot_dir).remotes.origin.pull()
-                        except:
-                            await send_message("Something went wrong.", bot_chat)
-                            return
-                        await send_message("Pulled successfully", bot_chat)
-                    else:
-                        console.log(
-                            f"[bold red]{user.get_username()} attempted to restart the bot"
-                        )
-                # Render LaTeX
-                elif msg.text.lower().startswith("!latex"):
-                    await send_message(
-                        f"![LaTeX](http://tex.z-dn.net/?f={quote(msg.text[7:])})",
-                        bot_chat,
-                    )
-
-
-                # Restart the bot
-                elif msg.text.lower().startswith("!restart"):
-                    if user in bot_admins:
-                        console.log("[bold red]Restarting bot")
-                        system(f"{executable} {__file__}")
-                        exit()
-                    else:
-                        console.log(
-                            f"[bold red]{user.get_username()} attempted to restart the bot"
-                        )
-                # Shut down the bot
-                elif msg.text.lower().startswith("!shutdown"):
-                    if user in bot_admins:
-                        console.log("[bold red]Shutting down bot")
-                        exit()
-                    else:
-                        console.log(
-                            f"[bold red]{user.get_username()} attempted to shut down the bot"
-                        )
-
-                file=open("TriviaQuestions.txt","r", encoding='utf-8')
-                record=file.readlines()
-                file.close()
-                QuestionsArray=[]
-                AnswersArray=[]
-                for value in record:
-                    question,answer=value.strip("\n").split(",")
-                    answer=answer.lower()
-                    QuestionsArray.append(question)
-                    AnswersArray.append(answer)
-                
-                
-                valid=True
-                if msg.text.lower().startswith("!trivia bypass"):
-                    if user in bot_admins:
-                        console.log(
-                            f"{user.get_username()} used the !trivia command [bold red](COOLDOWN BYPASS)"
-                        )
-
-                        trivia_cooldown.run(bypass=True)
-
-                        
-                        global Rinteger
-                        Rinteger=random.randint(0,len(QuestionsArray)-1)
-
-
-                        await send_message(QuestionsArray[Rinteger],bot_chat)
-
-                    else:
-                        console.log(
-                            f"[bold red]{user.get_username()} attempted to bypass the trivia cooldown"
-                        )
-                
-                elif msg.text.lower().startswith("!trivia"):
-                    if trivia_cooldown.run():
-                        
-                    
-                        #global Rinteger
-                        Rinteger=random.randint(0,len(QuestionsArray)-1)
-
-
-                        await send_message(QuestionsArray[Rinteger],bot_chat)
-                    else:
-                        console.log("Cancelled due to cooldown")
-
-                        # Get the invoking message
-                        message = await retry_until_available(
-                            bot_chat.get_message,
-                            msg.message_id,
-                            timeout=5.0,
-                            retry_delay=0.5,
-                        )
-
-                        # React to show the command is on cooldown
-                        await message.react("timer_clock")
-                elif msg.text.lower().startswith("!response") and valid==True:
-                    
-
-                    response=msg.text[10:]
-                    #response=response.replace(" ","")
-                    response=response.lower()
-
-                    if response == AnswersArray[Rinteger].lower():
-                        await send_message(f"Correct @{user.get_username()}! The answer was {AnswersArray[Rinteger]}",bot_chat)
-                    else:
-                        await send_message(f"Not quite @{user.get_username()}, try again.",bot_chat)
-
-                elif msg.text.lower().startswith("!answer"):
-                    await send_message(f"The answer is {AnswersArray[Rinteger]}, better luck next time.",bot_chat)
-                        
-                                           
-                if msg.text.lower()==("!define bypass"):
-                    if user in bot_admins:
-                        console.log(f"{user.get_username()} used the !define command [bold red](COOLDOWN BYPASS)")
-
-                        define_cooldown.run(bypass=True)
-                        word=msg.text.lower().lstrip("!define bypass")
-                        word= word.replace(' ', '')
-                        url = "https://www.merriam-webster.com/dictionary/"+ word +""
-                        r = requests.head(url)
-
-                        if r.status_code == 200:
-                            htmlfile = urllib.request.urlopen(url)
-                            soup = BeautifulSoup(htmlfile, 'lxml')
-
-                            soup1 = soup.find("span",class_="dtText")
-                            output=soup1.get_text()
-
-
-                            await send_message(str(output),bot_chat)
-                        else:
-                            
-                            await send_message("No Results Found",bot_chat)
-                                
-                elif msg.text.lower().startswith ("!define"):
-                    if define_cooldown.run():
-
-                        word=msg.text.lower().lstrip("!define")
-                        word= word.replace(' ', '')
-                        url = "https://www.merriam-webster.com/dictionary/"+ word +""
-                        r = requests.head(url)
-
-                        if r.status_code == 200:
-                            htmlfile = urllib.request.urlopen(url)
-                            soup = BeautifulSoup(htmlfile, 'lxml')
-
-                            soup1 = soup.find("span",class_="dtText")
-                            output=soup1.get_text()
-
-
-                            await send_message(str(output),bot_chat)
-                        else:
-                            
-                            await send_message("No Results Found",bot_chat)
-                    else:
-                        console.log("Cancelled due to cooldown")
-
-                        # Get the invoking message
-                        message = await retry_until_available(
-                            bot_chat.get_message,
-                            msg.message_id,
-                            timeout=5.0,
-                            retry_delay=0.5,
-                        )
-
-                        # React to show the command is on cooldown
-                        await message.react("timer_clock")
- 
- 
-                if msg.text.lower()==("!synonyms bypass"):
-                    if user in bot_admins:
-                        console.log(
-                            f"{user.get_username()} used the !synonyms command [bold red](COOLDOWN BYPASS)"
-                        )
-                        synonyms_cooldown.run(bypass=True)
-                        word=msg.text.lstrip("!synonyms bypass")
-                        word= word.replace(' ', '')
-
-
-                        url = "https://www.merriam-webster.com/thesaurus/"+ word +""
-                        r = requests.head(url)
-                           
-                        if r.status_code == 200:    
-                            htmlfile = urllib.request.urlopen(url)
-                            soup = BeautifulSoup(htmlfile, 'lxml')
+                    inputs.pop(0)
+                except ValueError:
+                    due_date = False
+
+            if due_date is False:
+                await outbox.send(
+                    "Ending time entered is not valid. You can any of these formats:\n `t=hh:mm;`\n `d=mm/dd/yyyy hh:mm;`\n`m=<minutes>;`\n**~Don't~ ~forget~ ~to~ ~use~ ~';'!~**",
+                    ctx.chat,
+                )
+                return
+
+            current_date = datetime.now(timezone(bot_user.get_time_zone()))
+
+            # In case of valid due time, check if it's already in the past
+            if (
+                due_date is not None
+                and int((due_date - current_date).total_seconds() / 60) <= 0
+            ):
+                await outbox.send(
+                    "Ending time entered is already in the past or too short",
+                    ctx.chat,
+                )
+                return
+
+            # Check if the command contains a valid number of arguments
+            if len(inputs) < 3:
+                await outbox.send(
+                    "Please enter a question and at least two options to create a poll",
+                    ctx.chat,
+                )
+                return
+            if len(inputs) > (len(poll_reactions) + 1):
+                await outbox.send(
+                    f"Your poll contained too many options, limit is {len(poll_reactions)} options",
+                    ctx.chat,
+                )
+                return
+
+            console.log(f'Creating poll "{inputs[0]}" for {ctx.username}')
+
+            # Create formatted poll text
+            poll_txt = "# {0}\n".format(inputs[0])
+            for i in range(1, len(inputs)):
+                poll_txt += ":{0}: {1}\n".format(poll_reactions[i - 1], inputs[i])
+
+            if due_date is not None:
+                poll_txt += "\n\n**Poll will end on {0} at {1} ({2})**".format(
+                    due_date.date(),
+                    due_date.time(),
+                    due_date.tzname(),
+                )
+            poll_id = await outbox.send(
+                poll_txt,
+                ctx.chat,
+                f"This poll was created by {ctx.username}",
+            )
+            poll_id = str(poll_id)
 
-                            soup1 = soup.find(class_="mw-list")
-                            text=soup1.get_text()
-                            output=text.strip("SYNONYMS")
+            # Start counting votes, replacing the chat's previous poll if it has no timer
+            tally = PollTally(
+                inputs, poll_reactions[: (len(inputs) - 1)], bot_user.get_id()
+            )
+            previous = latest_polls.get(ctx.chat.get_id())
+            if previous is not None and previous not in pending_polls:
+                poll_tallies.pop(previous, None)
+            poll_tallies[poll_id] = tally
+            latest_polls[ctx.chat.get_id()] = poll_id
+
+            # Add reaction options
+            for i in range(0, (len(inputs)) - 1):
+                await messages.react(poll_id, poll_reactions[i], ctx.chat)
+
+            if due_date is None:
+                return
+
+            # Save the poll so it's known after a restart
+            poll = {
+                "chat_id": ctx.chat.get_id(),
+                "inputs": inputs,
+                "reactions": poll_reactions[: (len(inputs) - 1)],
+                "due": due_date.timestamp(),
+                "timer": poll_timer,
+                "votes": tally.to_dict(),
+            }
+            pending_polls[poll_id] = poll
+            state.put("polls", poll_id, poll)
+
+            # Set ending timer locally, or using tasks if configured to
+            if poll_timer == "local":
+                poll_scheduler.schedule(poll_id, poll["due"])
+                return
+
+            task_body = "{0}".format(inputs[0])
+            # Add options to task message for later parsing
+            for i in inputs[1:]:
+                task_body += ";{0}".format(i)
+            # Add reactions used for later parsing
+            task_body += ";"
+            for i in poll_reactions[: (len(inputs) - 1)]:
+                task_body += ";{0}".format(i)
+            poll_task = await bot_task_board.create_task(
+                f"BrainBotPoll#{poll_id}",
+                task_body,
+                due_date=datetime_to_iso8601(due_date),
+            )
+            # Create task reminder
+            await remind_task(
+                ryver,
+                poll_task,
+                int((due_date - current_date).total_seconds() / 60),
+            )
 
+        # Show the current votes of the chat's latest poll
+        @commands.command("!poll status")
+        async def _poll_status(ctx):
+            tally = poll_tallies.get(latest_polls.get(ctx.chat.get_id()))
+            if tally is None:
+                await outbox.send("There's no poll running in this chat.", ctx.chat)
+                return
+            await outbox.send(tally.results("Poll status"), ctx.chat)
+
+        # Give a list of commands
+        @commands.command("!commands")
+        async def _commands(ctx):
+            console.log(f"Telling {ctx.username} my commands")
+            await outbox.send(
+                "Check out [my wiki](https://github.com/brainbotdev/brainbot/wiki) to learn what commands I understand.",
+                ctx.chat,
+            )
 
+        # Pull the latest changes from GitHub
+        @commands.command("!pull", admin=True)
+        async def _pull(ctx):
+            try:
+                Repo(bot_dir).remotes.origin.pull()
+            except:
+                await outbox.send("Something went wrong.", ctx.chat)
+                return
+            await outbox.send("Pulled successfully", ctx.chat)
+
+        # Render LaTeX
+        @commands.command("!latex")
+        async def _latex(ctx):
+            await outbox.send(
+                f"![LaTeX](http://tex.z-dn.net/?f={quote(ctx.args)})",
+                ctx.chat,
+            )
 
-                            await send_message(str(output),bot_chat)
-                        else:
-                            await send_message("No Results Found",bot_chat)
+        # Restart the bot
+        @commands.command("!restart", admin=True)
+        async def _restart(ctx):
+            console.log("[bold red]Restarting bot")
+            rate_limits.save()
+            state.flush()
+            system(f"{executable} {__file__}")
+            exit()
+
+        # Profile the bot for a while and send the report to the admin
+        @commands.command("!profile", admin=True)
+        async def _profile(ctx):
+            mode, _, seconds = ctx.args.strip().partition(" ")
+            mode = mode.lower() or "cpu"
+            seconds = seconds.strip() or "30"
+            if mode not in Profiler.MODES or not seconds.isdigit():
+                await outbox.send(
+                    "Command usage: `!profile [cpu|memory] [seconds]`", ctx.chat
+                )
+                return
+            if profiler.running:
+                await outbox.send("A profile is already being captured.", ctx.chat)
+                return
+
+            seconds = min(int(seconds), profiler.max_seconds)
+            console.log(f"{ctx.username} started a {seconds}s {mode} profile")
+            await outbox.send(
+                f"Profiling {mode} for {seconds} seconds, I'll send you the report.",
+                ctx.chat,
+            )
+            report = await profiler.capture(mode, seconds)
+            upload = await ryver.upload_file(
+                f"brainbot-{mode}-profile.txt", report.encode(), "text/plain"
+            )
+            await send_message(
+                f"Here's the {mode} profile you asked for.",
+                identities.dm(ctx.username),
+                attachment=upload,
+                from_user=bot_user,
+            )
 
-                        trivia_cooldown.run(bypass=True)
-                elif msg.text.lower().startswith ("!synonyms"):
-                    if synonyms_cooldown.run():
+        # Shut down the bot
+        @commands.command("!shutdown", admin=True)
+        async def _shutdown(ctx):
+            console.log("[bold red]Shutting down bot")
+            rate_limits.save()
+            state.flush()
+            exit()
+
+        # Ask a trivia question in this chat
+        @commands.command("!trivia", cooldown=trivia_cooldown, bypass=True, react=True)
+        async def _trivia(ctx):
+            try:
+                index = trivia_bank.random_index(ctx.args or None)
+            except KeyError:
+                names = trivia_bank.filter_names()
+                await outbox.send(
+                    "I don't have trivia about that"
+                    + (f", try one of: {', '.join(names)}" if names else "."),
+                    ctx.chat,
+                )
+                return
+            if index is None:
+                await outbox.send("No trivia questions are available.", ctx.chat)
+                return
+            session = trivia_sessions.get(ctx.chat.get_id())
+            session.ask(
+                trivia_bank.question(index),
+                trivia_bank.answer(index),
+                trivia_bank.normalized_answer(index),
+            )
+            trivia_sessions.save(session)
+
+            await outbox.send(session.question, ctx.chat)
+
+        # Check an answer to this chat's trivia question
+        @commands.command("!response")
+        async def _response(ctx):
+            session = trivia_sessions.get(ctx.chat.get_id())
+            if session.question is None:
+                await outbox.send("No trivia question has been asked yet.", ctx.chat)
+                return
+            if not session.active(trivia_sessions.timeout):
+                answer = session.close()
+                trivia_sessions.save(session)
+                await outbox.send(
+                    f"Time's up, the answer was {answer}. Ask another with !trivia.",
+                    ctx.chat,
+                )
+                return
+
+            answer = session.answer
+            if session.guess(ctx.username, ctx.args):
+                trivia_sessions.save(session)
+                await outbox.send(
+                    f"Correct @{ctx.username}! The answer was {answer}", ctx.chat
+                )
+            else:
+                await outbox.send(f"Not quite @{ctx.username}, try again.", ctx.chat)
+
+        # Give away the answer to this chat's trivia question
+        @commands.command("!answer")
+        async def _answer(ctx):
+            session = trivia_sessions.get(ctx.chat.get_id())
+            if session.question is None:
+                await outbox.send("No trivia question has been asked yet.", ctx.chat)
+                return
+            answer = session.close()
+            trivia_sessions.save(session)
+            await outbox.send(
+                f"The answer is {answer}, better luck next time.", ctx.chat
+            )
 
-                        word=msg.text.lstrip("!synonyms bypass")
-                        word= word.replace(' ', '')
+        # Show who answered the most trivia questions in this chat
+        @commands.command("!triviascores")
+        async def _trivia_scores(ctx):
+            session = trivia_sessions.get(ctx.chat.get_id())
+            if not session.scores:
+                await outbox.send(
+                    "No one has answered a trivia question yet.", ctx.chat
+                )
+                return
+            await outbox.send(
+                f"**Trivia leaderboard:** \n \n {session.leaderboard()}", ctx.chat
+            )
 
+        # Define a word
+        @commands.command("!define", cooldown=define_cooldown, bypass=True, react=True)
+        async def _define(ctx):
+            word = ctx.args.lower().replace(" ", "")
+            try:
+                output = await lookup_word(
+                    web_client, MW_DICTIONARY_URL, parse_definition, word, lookup_cache
+                )
+            except WebLookupError as e:
+                console.log(f"[red]{e}")
+                await outbox.send("Something went wrong.", ctx.chat)
+                return
+
+            if output is not None:
+                await outbox.send(str(output), ctx.chat)
+            else:
+                await outbox.send("No Results Found", ctx.chat)
+
+        # Give synonyms for a word
+        @commands.command(
+            "!synonyms", cooldown=synonyms_cooldown, bypass=True, react=True
+        )
+        async def _synonyms(ctx):
+            word = ctx.args.replace(" ", "")
+            try:
+                output = await lookup_word(
+                    web_client, MW_THESAURUS_URL, parse_synonyms, word, lookup_cache
+                )
+            except WebLookupError as e:
+                console.log(f"[red]{e}")
+                await outbox.send("Something went wrong.", ctx.chat)
+                return
+
+            if output is not None:
+                await outbox.send(str(output), ctx.chat)
+            else:
+                await outbox.send("No Results Found", ctx.chat)
+
+        # Flip a coin
+        @commands.command("!coinflip")
+        async def _coinflip(ctx):
+            if ctx.args:
+                return
+            flip = random.randint(0, 1)
+            if flip == 0:
+                await outbox.send("Tails", ctx.chat)
+
+            elif flip == 1:
+                await outbox.send("Heads", ctx.chat)
+
+        # Check if a link is a troll link
+        @commands.command("!rickroll")
+        async def _rickroll(ctx):
+            if "http" in ctx.args:
+                url = ctx.args
+
+                # Keywords
+                keywords = [
+                    "Rick",
+                    "Astley",
+                    "Rick Astley - Never Gonna Give You Up (Video)",
+                    "Official Rick Astley",
+                    "Never gonna give you up",
+                    "Never gonna let you down",
+                    "Never gonna run around and desert you",
+                    "Never gonna make you cry",
+                    "Never gonna say goodbye",
+                    "Never gonna tell a lie and hurt you",
+                    "Stick Bugged",
+                    "Get Stick Bugged Lol",
+                ]
+                try:
+                    status, body = await web_client.fetch(url)
+                except WebLookupError as e:
+                    console.log(f"[red]{e}")
+                    await outbox.send("I couldn't open that link.", ctx.chat)
+                    return
+                content = body.decode(errors="ignore").lower()
+
+                # checks to see if
+                if any(el.lower() in content for el in keywords):
+                    await outbox.send(f"Looks like a troll link!", ctx.chat)
+                else:
+                    await outbox.send(
+                        f"You can be sure that this isn't a troll link!", ctx.chat
+                    )
 
-                        url = "https://www.merriam-webster.com/thesaurus/"+ word +""
-                        r = requests.head(url)
-                           
-                        if r.status_code == 200:    
-                            htmlfile = urllib.request.urlopen(url)
-                            soup = BeautifulSoup(htmlfile, 'lxml')
+        # cards against humanity
+        async def gameStart(game, chat):
+            judge = random.choice(list(game.players))
+            game.start_round(judge)
+            games.save(game)
+
+            blackCard = deck.black[game.black_card]
+            cardUrl = await card_cache.url(ryver, blackCard)
+
+            hands = []
+            for player in game.playing.values():
+                cardList = ""
+                for index, card in enumerate(player.cards):
+                    cardList += f"{str(index+1)}. {deck.white[card]} \n"
+                hands.append(
+                    (
+                        f"**This is your current set of cards:**\n *Send `!card <card number>` in the game chat to select a card.* \n\n {cardList}",
+                        identities.dm(player.name),
+                    )
+                )
+
+            async def announce():
+                await outbox.send(
+                    f"![{blackCard}]({cardUrl})", chat, priority=outbox.HIGH
+                )
+                await outbox.send(
+                    f"@{judge} is the judge for this round.",
+                    chat,
+                    priority=outbox.HIGH,
+                )
+
+            # Deal hands by DM while the round is announced, instead of one after another
+            await gather(announce(), outbox.fan_out(hands))
+
+        @commands.command("!cah")
+        async def _cah(ctx):
+            roundCount, *packs = ctx.args.replace(",", " ").split() or [""]
+            if not roundCount.isdigit() or int(roundCount) < 1:
+                await outbox.send(
+                    "Missing Arguments: Must add the number of rounds after command. `!cah <number of rounds> [packs]`",
+                    ctx.chat,
+                )
+                return
+            unknown = [pack for pack in packs if pack not in deck.packs()]
+            if unknown:
+                await outbox.send(
+                    f"Unknown packs: {', '.join(unknown)}. "
+                    f"Packs you can pick from: {', '.join(deck.packs())}",
+                    ctx.chat,
+                )
+                return
+            if games.get(ctx.chat.get_id()) is not None:
+                await outbox.send(
+                    "There's already a game in this chat, send `!end` to end it.",
+                    ctx.chat,
+                )
+                return
+
+            game = games.create(ctx.chat.get_id(), int(roundCount), packs or None)
+            game.add_player(ctx.username)
+            games.save(game)
+            await outbox.send(
+                f"{ctx.username} is starting a game of Cards Against Humanity, send `!join` in this chat to join!",
+                ctx.chat,
+            )
 
-                            soup1 = soup.find(class_="mw-list")
-                            text=soup1.get_text()
-                            output=text.strip("SYNONYMS")
+        @commands.command("!join")
+        async def _join(ctx):
+            game = games.get(ctx.chat.get_id())
+            if game is None or not game.waiting_for_join:
+                return
+            async with game.lock:
+                if ctx.username in game.players:
+                    await outbox.send(
+                        f"@{ctx.username} You are in the game already.", ctx.chat
+                    )
+                else:
+                    game.add_player(ctx.username)
+                    games.save(game)
+                    await outbox.send(f"Welcome to the game @{ctx.username}!", ctx.chat)
+
+        @commands.command("!start")
+        async def _start(ctx):
+            game = games.get(ctx.chat.get_id())
+            if game is None:
+                return
+            async with game.lock:
+                if game.running:
+                    return
+                if len(game.players) < 3:
+                    await outbox.send("Not enough players", ctx.chat)
+                    return
 
-                            await send_message(str(output),bot_chat)
-                        else:
-                            await send_message("No Results Found",bot_chat)
-                    else:
-                        console.log("Cancelled due to cooldown")
-
-                        # Get the invoking message
-                        message = await retry_until_available(
-                            bot_chat.get_message,
-                            msg.message_id,
-                            timeout=5.0,
-                            retry_delay=0.5,
-                        )
+                if not game.deal_hands():
+                    await outbox.send(
+                        f"There aren't enough cards in this game's packs for {len(game.players)} players",
+                        ctx.chat,
+                    )
+                    return
+                game.waiting_for_join = False
+
+                await gameStart(game, ctx.chat)
+
+        # in-game commands here
+        @commands.command("!card")
+        async def _card(ctx):
+            game = games.get(ctx.chat.get_id())
+            if game is None:
+                return
+            userChat = identities.chat(ctx.user.get_id())
+            async with game.lock:
+                if game.selection_time:
+                    return
+                player = game.playing.get(ctx.username)
+                if player is None:
+                    await outbox.send("You are not in this game", userChat)
+                    return
 
-                        # React to show the command is on cooldown
-                        await message.react("timer_clock")
-
-                if msg.text.lower()=="!coinflip":
-                    flip=random.randint(0,1)
-                    if flip==0:
-                        await send_message("Tails",bot_chat)
-
-                    elif flip==1:
-                        await send_message("Heads",bot_chat)
-                if msg.text.lower().startswith("!rickroll"):
-                    msg.text=msg.text.lstrip("!rickroll ")
-                    if "http" in msg.text:
-                       
-                        url= msg.text
-                       
-                        headers = {'User-Agent': '<yourUserAgent>'}
-                        #Keywords
-                        keywords = ['Rick','Astley','Rick Astley - Never Gonna Give You Up (Video)','Official Rick Astley','Never gonna give you up','Never gonna let you down','Never gonna run around and desert you','Never gonna make you cry','Never gonna say goodbye','Never gonna tell a lie and hurt you','Stick Bugged','Get Stick Bugged Lol']
-                        response = requests.get(url, headers=headers)
-
-                        found_keywords = 0
-                        #checks to see if
-                        for el in keywords:
-                            if el.lower() in str(response.content).lower():
-                                await send_message(f"Looks like a troll link!",bot_chat)
-                                break
-                        for el in keywords:
-                            if el.lower() in str(response.content).lower():
-                                found_keywords = found_keywords+1
-
-                        if found_keywords == 0:
-                            await send_message(f"You can be sure that this isn't a troll link!",bot_chat)
-                
-                #cards against humanity
-                async def gameStart():
-                    game['selectionTime'] = False
-
-                    imgGen = ImageGenerator()
-                    global randomQ
-                    randomQ = random.choice(cah['black'])['text']
-                    imgGen.createImage(randomQ, "black.png")
-
-                    fileCard = await ryver.upload_file("black", open("black.png", "rb"), "png")
-
-                    for player in game['players']:
-                        player['selectedCard'] = ''
-                    
-                    game['playing'] = list(game['players']) 
-
-                    queen = game['playing'].pop(random.randint( 0, len(game['playing'])-1 ))
-
-                    for player in game['playing']:
-                        playerObj = ryver.get_user(username=player['name'])
-
-                        cardList = ''
-                        for index, card in enumerate(player['cards']): 
-                            cardList += f"{str(index+1)}. {card} \n"
-                        await send_message(
-                            f"**This is your current set of cards:**\n *Send `!card <card number>` in the game chat to select a card.* \n\n {cardList}",
-                            ryver.get_chat(id=playerObj.get_id())
-                        )
+                try:
+                    everyoneSelected = game.play(player, int(ctx.args.strip()) - 1)
+                except (ValueError, IndexError):
+                    await outbox.send(
+                        f"Please pick a card between 1 and {len(player.cards)}",
+                        userChat,
+                    )
+                    return
+                games.save(game)
+
+                selectedCard = deck.white[player.selected_card]
+                await outbox.send(
+                    f"**You Selected the card:** {selectedCard}", userChat
+                )
+                await outbox.send(f"@{ctx.username} has selected a card!", ctx.chat)
+
+                if everyoneSelected:
+                    allCards = ""
+                    for index, player in enumerate(game.playing.values()):
+                        allCards += f"{index+1}. {deck.white[player.selected_card]} \n"
+                    await outbox.send(
+                        f"@{game.judge.name}, Pick a winning card: (!pick <number>) \n **{deck.black[game.black_card]}** \n {allCards}",
+                        ctx.chat,
+                        priority=outbox.HIGH,
+                    )
 
-                    await send_message(
-                        f"![{randomQ}]({fileCard.get_content_url()})",
-                        bot_chat
+        @commands.command("!pick")
+        async def _pick(ctx):
+            game = games.get(ctx.chat.get_id())
+            if game is None:
+                return
+            async with game.lock:
+                if not game.selection_time:
+                    return
+                try:
+                    selection = int(ctx.args.strip())
+                    if selection < 1:
+                        raise IndexError
+                    winner = list(game.playing.values())[selection - 1]
+                except (ValueError, IndexError):
+                    await outbox.send(
+                        f"Please pick a card between 1 and {len(game.playing)}",
+                        ctx.chat,
                     )
+                    return
 
-                    game['cardQueen'] = queen
-                    await send_message(
-                        f"@{queen['name']} is the judge for this round.",
-                        bot_chat
+                winner.points += 1
+                game.running = False
+                game.selection_time = False
+                games.save(game)
+                await outbox.send(f"@{winner.name} won the round!", ctx.chat)
+
+                userScore = game.scores(mention=True)
+
+                if game.rounds_left > 0:
+                    await outbox.send(f"**Current Points:** \n {userScore} ", ctx.chat)
+                    await gameStart(game, ctx.chat)
+                else:
+                    # rounds finished
+                    games.end(game.chat_id)
+                    await outbox.send(
+                        f"**The game has ended.** \n Scores: \n {userScore} ", ctx.chat
                     )
-                    game['running'] = True
-                    game['roundsLeft'] -= 1
-                
-                if msg.text.lower().startswith("!cah"):
-                    roundCount = msg.text.lstrip("!cah ").strip()
-                    if(roundCount):
-                        await send_message(
-                            f"{user.get_username()} is starting a game of Cards Against Humanity, send `!join` in this chat to join!",
-                            bot_chat
-                        )
 
-                        global game
-                        game['players'].append({
-                            'name': user.get_username(),
-                            'points': 0,
-                            'cards': [],
-                            'selectedCard': ''
-                        })
-                        
-                        game['roundsLeft'] = int(roundCount)
-                        game['readCommands'] = True
-                        game['waitingForJoin'] = True
-                    else:
-                        await send_message(
-                            "Missing Arguments: Must add the number of rounds after command. `!cah <number of rounds>`",
-                            bot_chat
-                        )
+        @commands.command("!scores")
+        async def _scores(ctx):
+            game = games.get(ctx.chat.get_id())
+            if game is None:
+                return
+            await outbox.send(f"**Leaderboard:** \n \n {game.scores()}", ctx.chat)
+
+        @commands.command("!end")
+        async def _end(ctx):
+            if games.get(ctx.chat.get_id()) is None:
+                return
+            games.end(ctx.chat.get_id())
+            await outbox.send(f"@{ctx.username} ended the game.", ctx.chat)
+
+        # Chats the bot listens in, by JID
+        chats = {bot_chat.get_jid(): bot_chat}
+        for chat_id in config.get("misc", "extra_chats", fallback="").split(","):
+            if not chat_id.strip():
+                continue
+            chat = identities.chat(int(chat_id)) if chat_id.strip().isdigit() else None
+            if chat is None:
+                console.log(
+                    f"[red]Skipping unknown chat {chat_id.strip()!r} in extra_chats"
+                )
+                continue
+            chats[chat.get_jid()] = chat
 
-                if(game['readCommands']):
-                    if(game['waitingForJoin'] and msg.text.lower().startswith("!join")):
-                        if(next((player for player in game['players'] if player['name'] == user.get_username()), None)):
-                            await send_message(
-                                f"@{user.get_username()} You are in the game already.",
-                                bot_chat
-                            )
-                        else:
-                            game['players'].append({
-                                'name': user.get_username(),
-                                'points': 0,
-                                'cards': [],
-                                'selectedCard': ''
-                            })
-                            await send_message(
-                                f"Welcome to the game @{user.get_username()}!",
-                                bot_chat
-                            )
-
-                    if((not game['running']) and msg.text.lower().startswith("!start")):
-                        if(len(game['players']) >= 3):
-                            game['waitingForJoin'] = False
-                            for player in game['players']:
-                                whiteCards = []
-                                
-                                #distribute starting cards
-                                for a in range(10):
-                                    whiteCards.append(random.choice(cah['white'])['text'])
-                                player['cards'] = whiteCards
-
-                            await gameStart()
-
-
-                        else:
-                            await send_message(
-                                "Not enough players",
-                                bot_chat
-                            )
-                    else:
-                    #in-game commands here
-
-                        if(msg.text.lower().startswith("!card")):
-                            selected = msg.text.lstrip("!card ").strip()
-                            thisUser = ryver.get_user(jid=msg.from_jid)
-                            userInfo = next((player for player in game['players'] if player['name'] == user.get_username()), None)
-                            playerInfo = next((player for player in game['playing'] if player['name'] == user.get_username()), None)
-
-                            if(playerInfo):
-                                selectedCard = userInfo['cards'].pop(int(selected)-1)
-                                userInfo['cards'].append(random.choice(cah['white'])['text'])
-
-                                await send_message(
-                                    f"**You Selected the card:** {selectedCard}",
-                                    ryver.get_chat(id=thisUser.get_id())
-                                )
-                                await send_message(
-                                    f"@{user.get_username()} has selected a card!",
-                                    bot_chat
-                                )
-                                playerInfo['selectedCard'] = selectedCard
-
-                                if(not next((player for player in game['playing'] if not player['selectedCard']), None)):
-                                    allCards = ''
-                                    for index, player in enumerate(game['playing']): 
-                                        allCards += f"{index+1}. {player['selectedCard']} \n"
-                                    await send_message(
-                                        f"@{game['cardQueen']['name']}, Pick a winning card: (!pick <number>) \n **{randomQ}** \n {allCards}",
-                                        bot_chat
-                                    )
-                                    game['selectionTime'] = True
-                            else:
-                                await send_message(
-                                    "You are not in this game",
-                                    ryver.get_chat(id=thisUser.get_id())
-                                )
-                                
-
-                        elif(msg.text.lower().startswith("!pick") and game['selectionTime']):
-                            selection = int(msg.text.lstrip("!pick ").strip())
-                            winner = game['playing'][selection-1]
-                            winner['points'] += 1
-                            await send_message(
-                                f"@{winner['name']} won the round!",
-                                bot_chat
-                            )
-                            game['running'] = False
-
-                            userScore = ''
-                            for player in game['players']:
-                                userScore += f"@{player['name']} : {str(player['points'])} \n"
-
-                            if(game['roundsLeft'] > 0):
-                                await send_message(
-                                    f"**Current Points:** \n {userScore} ",
-                                    bot_chat
-                                )
-                                await gameStart()
-                            else:
-                                #rounds finished
-                
-                                await send_message(
-                                    f"**The game has ended.** \n Scores: \n {userScore} ",
-                                    bot_chat
-                                )
-                                game = {
-                                    'running': False,
-                                    'waitingForJoin': False,
-                                    'readCommands': False,
-                                    'players': [],
-                                    'playing': [],
-                                    'roundsLeft': 2,
-                                    'selectionTime': False,
-                                    'cardQueen': '' #username of card queen
-                                }
-
-
-
-                        elif(msg.text.lower().startswith("!scores")):
-                            userScore = ''
-                            for player in game['players']:
-                                userScore += f"{player['name']} : {str(player['points'])} \n"
-                            await send_message(
-                                f"**Leaderboard:** \n \n {userScore}",
-                                bot_chat
-                            )
-                        
-
-                        elif(msg.text.lower().startswith("!end")):
-                            game = {
-                                'running': False,
-                                'waitingForJoin': False,
-                                'readCommands': False,
-                                'players': [],
-                                'playing': [],
-                                'roundsLeft': 2,
-                                'selectionTime': False,
-                                'cardQueen': '' #username of card queen
-                            }
-                            await send_message(
-                                f"@{user.get_username()} ended the game.",
-                                bot_chat
-                            )
+        async with ryver.get_live_session() as session:
+            console.log("In live session")
+            metrics.websocket_connects.inc()
+
+            @session.on_chat
+            async def _on_chat(msg):
+                # Stop if message wasn't sent to one of the bot's chats
+                chat = chats.get(msg.to_jid)
+                if chat is None:
+                    return
+
+                messages.add(msg.message_id, chat, msg.text)
+                await commands.dispatch(msg, chat)
 
             @session.on_event(RyverWS.EVENT_ALL)
             async def _on_event(event: WSEventData):
                 # Check if it's an incoming notification event
                 # (Notification event type constant doesn't exist on PyRyver, so I hardcoded it)
                 if event.event_type == "/api/notify":
-                    notif = await Notification.get_by_id(
-                        ryver, obj_id=event.event_data.get("id")
-                    )
-                    await handle_notification(
-                        ryver=ryver, notification=notif, bot_chat=bot_chat
-                    )
+                    await notifications.on_event(event.event_data)
+
+                # Reload users whose details changed
+                elif event.event_type == RyverWS.EVENT_ENTITY_CHANGED:
+                    entity = event.event_data.get("entity") or {}
+                    entity_type = entity.get("__metadata", {}).get("type")
+                    if entity_type == "Entity.User" and entity.get("id") is not None:
+                        await identities.refresh_user(
+                            entity["id"], event.event_data.get("change", "updated")
+                        )
+
+                # Count poll votes as reactions are added and removed
+                elif event.event_type in (
+                    RyverWS.EVENT_REACTION_ADDED,
+                    RyverWS.EVENT_REACTION_REMOVED,
+                ):
+                    poll_id = str(event.event_data.get("id"))
+                    tally = poll_tallies.get(poll_id)
+                    if tally is None:
+                        return
+                    reaction = event.event_data.get("reaction")
+                    user_id = event.event_data.get("userId")
+                    if event.event_type == RyverWS.EVENT_REACTION_ADDED:
+                        changed = tally.add(reaction, user_id)
+                    else:
+                        changed = tally.remove(reaction, user_id)
+                    if changed and poll_id in pending_polls:
+                        save_poll(poll_id)
 
             @session.on_connection_loss
             async def _on_connection_loss():
+                metrics.websocket_losses.inc()
                 await session.close()
 
+            # Handle unread notifications from last session now that new ones arrive live,
+            # so none are missed between the two. Nothing is flushed until the backlog is
+            # handled, or unhandled reminders in it would be marked read.
+            async def drain_notifications():
+                await notifications.drain(ryver.get_notifs(unread=True))
+                await notifications.autoflush()
+
+            create_task(drain_notifications())
+
             await session.run_forever()
 
+        await outbox.close()
+        await web_client.close()
+        lookup_cache.close()
+        image_generator.close()
+        translator.close()
+        evaluator.close()
+        rate_limits.save()
+        state.close()
+        if metrics_server is not None:
+            await metrics_server.cleanup()
+
 
 # Run the async main function that was just defined
 get_event_loop().run_until_complete(main())
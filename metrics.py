@@ -0,0 +1,230 @@
+import re
+from asyncio import sleep
+from bisect import bisect_left
+from functools import partial
+from time import monotonic
+
+from aiohttp import TraceConfig, web
+
+# Latency buckets in seconds, from a cached lookup to a slow scrape
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(names, values, extra=""):
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+# A metric with a value per combination of label values
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        # Unlabelled counters and gauges start at zero so they're scraped before changing
+        self.values = {} if self.labels else {(): 0}
+
+    def key(self, labels):
+        return tuple(labels[name] for name in self.labels)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.type}"
+        for key, value in self.values.items():
+            yield f"{self.name}{format_labels(self.labels, key)} {value}"
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value: float, **labels):
+        self.values[self.key(labels)] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        self.values = {}
+
+    def observe(self, value: float, **labels):
+        key = self.key(labels)
+        counts = self.values.get(key)
+        if counts is None:
+            # One count per bucket plus +Inf, then the sum of observed values
+            counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.type}"
+        for key, counts in self.values.items():
+            total = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                total += count
+                labels = format_labels(self.labels, key, f'le="{bound}"')
+                yield f"{self.name}_bucket{labels} {total}"
+            yield f"{self.name}_sum{format_labels(self.labels, key)} {counts[-1]}"
+            yield f"{self.name}_count{format_labels(self.labels, key)} {total}"
+
+
+# Every metric the bot exposes, rendered in the Prometheus text format
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric: Metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        return (
+            "\n".join(line for metric in self.metrics for line in metric.render())
+            + "\n"
+        )
+
+
+registry = Registry()
+
+command_calls = registry.add(
+    Counter("brainbot_commands_total", "Commands run", ("command",))
+)
+command_errors = registry.add(
+    Counter(
+        "brainbot_command_errors_total", "Commands that raised an error", ("command",)
+    )
+)
+command_seconds = registry.add(
+    Histogram("brainbot_command_seconds", "Time taken to run commands", ("command",))
+)
+cooldown_rejections = registry.add(
+    Counter(
+        "brainbot_cooldown_rejections_total",
+        "Commands rejected by their cooldown",
+        ("command",),
+    )
+)
+http_requests = registry.add(
+    Counter(
+        "brainbot_http_requests_total",
+        "Outbound HTTP requests by endpoint and status (0 if no response)",
+        ("endpoint", "status"),
+    )
+)
+http_seconds = registry.add(
+    Histogram(
+        "brainbot_http_request_seconds",
+        "Time taken by outbound HTTP requests",
+        ("endpoint",),
+    )
+)
+websocket_connects = registry.add(
+    Counter("brainbot_websocket_connects_total", "Live sessions started")
+)
+websocket_losses = registry.add(
+    Counter(
+        "brainbot_websocket_connection_losses_total", "Live session connections lost"
+    )
+)
+loop_lag = registry.add(
+    Gauge(
+        "brainbot_event_loop_lag_seconds", "How late the last event loop sample woke up"
+    )
+)
+card_render_seconds = registry.add(
+    Histogram("brainbot_card_render_seconds", "Time taken to render CAH cards")
+)
+
+# Ryver API calls are labelled by their type and action without IDs or arguments,
+# e.g. forums(123)/Chat.PostMessage() -> forums/Chat.PostMessage
+ODATA_ARGS = re.compile(r"\([^)]*\)")
+
+# Other hosts the bot calls, by label. Everything else (e.g. the user supplied links
+# !rickroll checks) shares one label so users can't create new series.
+HOSTS = {"www.merriam-webster.com": "merriam-webster"}
+
+
+def endpoint(url, api: bool = False):
+    """Label a request URL, by its Ryver API call if `api` is set or else by host."""
+    if api:
+        path = url.path
+        if "/odata.svc/" in path:
+            return ODATA_ARGS.sub("", path.split("/odata.svc/", 1)[1]) or "/"
+        return "ryver"
+    return HOSTS.get(url.host, "other")
+
+
+async def on_request_start(session, context, params):
+    context.started = monotonic()
+
+
+async def on_request_end(api, session, context, params):
+    name = endpoint(params.url, api)
+    http_requests.inc(endpoint=name, status=params.response.status)
+    http_seconds.observe(monotonic() - context.started, endpoint=name)
+
+
+async def on_request_exception(api, session, context, params):
+    name = endpoint(params.url, api)
+    http_requests.inc(endpoint=name, status=0)
+    http_seconds.observe(monotonic() - context.started, endpoint=name)
+
+
+def trace_config(api: bool = False):
+    """
+    Get an aiohttp TraceConfig that records request counts and latencies. Only sessions
+    that talk to the Ryver API should set `api`, other URLs are labelled by host.
+    """
+    config = TraceConfig()
+    config.on_request_start.append(on_request_start)
+    config.on_request_end.append(partial(on_request_end, api))
+    config.on_request_exception.append(partial(on_request_exception, api))
+    config.freeze()
+    return config
+
+
+def instrument(session):
+    """Record the requests of an existing session, e.g. the one pyryver creates."""
+    session._trace_configs.append(trace_config(api=True))
+
+
+async def sample_loop_lag(interval: float = 1.0):
+    while True:
+        started = monotonic()
+        await sleep(interval)
+        loop_lag.set(max(0.0, monotonic() - started - interval))
+
+
+async def handle_metrics(request):
+    return web.Response(
+        text=registry.render(), content_type="text/plain", charset="utf-8"
+    )
+
+
+async def serve(host: str = "127.0.0.1", port: int = 9100):
+    """Serve the metrics at /metrics, returning the runner to clean up on exit."""
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
@@ -0,0 +1,73 @@
+import json
+import sqlite3
+from asyncio import sleep
+from time import perf_counter
+
+from utils import bot_dir, console
+
+
+# Embedded SQLite store for live state (games, polls, trivia) that should survive restarts
+class StateStore:
+    def __init__(self, path=bot_dir / "state.db"):
+        self.db = sqlite3.connect(str(path))
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS state ("
+            "kind TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, "
+            "PRIMARY KEY (kind, key))"
+        )
+        self.db.commit()
+        # Writes waiting for the next flush, None meaning the key should be deleted
+        self.pending = {}
+
+    def put(self, kind: str, key, value):
+        self.pending[(kind, str(key))] = json.dumps(value)
+
+    def delete(self, kind: str, key):
+        self.pending[(kind, str(key))] = None
+
+    def load(self, kind: str):
+        """Get every saved value of a kind, including writes that haven't been flushed."""
+        started = perf_counter()
+        values = {
+            key: json.loads(value)
+            for key, value in self.db.execute(
+                "SELECT key, value FROM state WHERE kind = ?", (kind,)
+            )
+        }
+        for (pending_kind, key), value in self.pending.items():
+            if pending_kind != kind:
+                continue
+            if value is None:
+                values.pop(key, None)
+            else:
+                values[key] = json.loads(value)
+        console.log(
+            f"Loaded {len(values)} saved {kind} in {(perf_counter() - started) * 1000:.1f}ms"
+        )
+        return values
+
+    def flush(self):
+        """Write every pending change in a single transaction."""
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, {}
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO state VALUES (?, ?, ?)",
+                [(*key, value) for key, value in pending.items() if value is not None],
+            )
+            self.db.executemany(
+                "DELETE FROM state WHERE kind = ? AND key = ?",
+                [key for key, value in pending.items() if value is None],
+            )
+
+    async def autoflush(self, interval: float = 1.0):
+        while True:
+            await sleep(interval)
+            self.flush()
+
+    def close(self):
+        self.flush()
+        self.db.close()
@@ -0,0 +1,337 @@
+import csv
+import html
+import json
+import os
+import re
+import unicodedata
+from argparse import ArgumentParser
+from io import BytesIO
+from pathlib import Path
+from struct import Struct
+from time import time
+
+# Compiled trivia packs are read through mmap, laid out as:
+#   header | index table | question table | index arrays | strings
+# Index arrays hold the question numbers of each category or difficulty as uint32s
+PACK_MAGIC = b"BBTRIVIA"
+PACK_VERSION = 1
+# Magic, version, number of questions, number of indexes
+PACK_HEADER = Struct("<8sIII")
+# Kind (category or difficulty), name length, name offset, array offset, array length
+PACK_INDEX = Struct("<B3xIQQI")
+# Strings offset, question, answer and normalized answer lengths, category, difficulty
+PACK_QUESTION = Struct("<QHHHHB")
+PACK_NUMBER = Struct("<I")
+CATEGORY, DIFFICULTY = 0, 1
+DIFFICULTIES = ("", "easy", "medium", "hard")
+NO_CATEGORY = 0xFFFF
+
+ARTICLES = frozenset(("a", "an", "the"))
+NON_WORD = re.compile(r"[\W_]+")
+
+
+def normalize_answer(text: str):
+    """
+    Reduce an answer to lowercase words without accents, punctuation or articles, so
+    "The Jack-o'-Lantern." and "jack o lantern" compare equal.
+    """
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    words = NON_WORD.sub(" ", text.casefold()).split()
+    # Keep the articles if they're the whole answer
+    return " ".join(word for word in words if word not in ARTICLES) or " ".join(words)
+
+
+def allowed_typos(answer: str):
+    # Numbers have to be exact, and short words only get one typo if they're long enough
+    if any(char.isdigit() for char in answer):
+        return 0
+    if len(answer) <= 3:
+        return 0
+    if len(answer) <= 7:
+        return 1
+    return 2
+
+
+def within_distance(a: str, b: str, limit: int):
+    """Check if the edit distance of a and b is at most `limit`, giving up early."""
+    if a == b:
+        return True
+    if abs(len(a) - len(b)) > limit:
+        return False
+    if limit == 0:
+        return False
+    if len(a) > len(b):
+        a, b = b, a
+
+    # Only cells within `limit` of the diagonal can stay under the limit
+    too_far = limit + 1
+    previous = list(range(len(b) + 1))
+    for i, char in enumerate(a, start=1):
+        current = [too_far] * (len(b) + 1)
+        if i <= limit:
+            current[0] = i
+        low = max(1, i - limit)
+        high = min(len(b), i + limit)
+        best = current[0]
+        for j in range(low, high + 1):
+            cost = previous[j - 1] + (char != b[j - 1])
+            cost = min(cost, previous[j] + 1, current[j - 1] + 1)
+            current[j] = cost
+            if cost < best:
+                best = cost
+        if best > limit:
+            return False
+        previous = current
+    return previous[-1] <= limit
+
+
+def answer_matches(guess: str, answer: str):
+    """Check a guess against an answer that was already normalized."""
+    return within_distance(normalize_answer(guess), answer, allowed_typos(answer))
+
+
+# The trivia question being played in a chat, and the chat's scores
+class TriviaSession:
+    __slots__ = ("chat_id", "question", "answer", "normalized", "asked_at", "scores")
+
+    def __init__(self, chat_id: int):
+        self.chat_id = chat_id
+        self.question = None
+        # The answer as shown, and as compared against guesses
+        self.answer = None
+        self.normalized = None
+        self.asked_at = 0.0
+        # Correct answers by username
+        self.scores = {}
+
+    def ask(self, question: str, answer: str, normalized: str):
+        self.question = question
+        self.answer = answer
+        self.normalized = normalized
+        self.asked_at = time()
+
+    def active(self, timeout: float):
+        return self.question is not None and time() - self.asked_at < timeout
+
+    def close(self):
+        """Finish the question, returning its answer."""
+        answer = self.answer
+        self.question = self.answer = self.normalized = None
+        return answer
+
+    def guess(self, username: str, text: str):
+        """Check a guess, scoring and finishing the question if it's right."""
+        if not answer_matches(text, self.normalized):
+            return False
+        self.scores[username] = self.scores.get(username, 0) + 1
+        self.close()
+        return True
+
+    def leaderboard(self):
+        ranked = sorted(self.scores.items(), key=lambda item: item[1], reverse=True)
+        return "".join(f"{name} : {points} \n" for name, points in ranked)
+
+    def to_dict(self):
+        return {
+            "chat_id": self.chat_id,
+            "question": self.question,
+            "answer": self.answer,
+            "normalized": self.normalized,
+            "asked_at": self.asked_at,
+            "scores": self.scores,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        session = cls(data["chat_id"])
+        session.question = data["question"]
+        session.answer = data["answer"]
+        session.normalized = data["normalized"]
+        session.asked_at = data["asked_at"]
+        session.scores = data["scores"]
+        return session
+
+
+# Trivia sessions, keyed by the ID of the chat they're played in
+class TriviaSessions:
+    def __init__(self, state=None, timeout: float = 300):
+        self.sessions = {}
+        # Seconds a question can be answered for
+        self.timeout = timeout
+        # Optional StateStore the sessions are saved to, so they survive restarts
+        self.state = state
+        if state is not None:
+            for data in state.load("trivia_sessions").values():
+                session = TriviaSession.from_dict(data)
+                self.sessions[session.chat_id] = session
+
+    def get(self, chat_id: int):
+        session = self.sessions.get(chat_id)
+        if session is None:
+            session = self.sessions[chat_id] = TriviaSession(chat_id)
+        return session
+
+    def save(self, session: TriviaSession):
+        if self.state is not None:
+            self.state.put("trivia_sessions", session.chat_id, session.to_dict())
+
+    def __len__(self):
+        return len(self.sessions)
+
+
+def read_csv(path: Path, category: str = "", difficulty: str = ""):
+    """
+    Read "question,answer[,category[,difficulty]]" rows, quoted where they contain
+    commas. A header row naming the columns may put them in any order.
+    """
+    with open(path, encoding="utf-8", newline="") as file:
+        rows = csv.reader(file)
+        columns = ["question", "answer", "category", "difficulty"]
+        for number, row in enumerate(rows, start=1):
+            fields = [field.strip() for field in row]
+            if not any(fields):
+                continue
+            lowered = [
+                field.lower().replace("correct_answer", "answer") for field in fields
+            ]
+            if number == 1 and "question" in lowered and "answer" in lowered:
+                columns = lowered
+                continue
+            values = dict(zip(columns, fields))
+            yield (
+                values.get("question", ""),
+                values.get("answer", ""),
+                values.get("category") or category,
+                values.get("difficulty") or difficulty,
+            )
+
+
+def read_json(path: Path, category: str = "", difficulty: str = ""):
+    """
+    Read a list of question objects, or an Open Trivia DB response with them under
+    "results" and HTML escaped text.
+    """
+    with open(path, encoding="utf-8") as file:
+        data = json.load(file)
+    if isinstance(data, dict):
+        data = data.get("results", [])
+    for item in data:
+        answer = item.get("answer", item.get("correct_answer", ""))
+        yield (
+            html.unescape(str(item.get("question", ""))).strip(),
+            html.unescape(str(answer)).strip(),
+            html.unescape(str(item.get("category") or category)).strip(),
+            str(item.get("difficulty") or difficulty).strip(),
+        )
+
+
+def write_pack(records, path: Path):
+    """
+    Compile (question, answer, category, difficulty) records into a trivia pack,
+    returning the number of questions written and skipped.
+    """
+    strings = BytesIO()
+    questions = []
+    # Index name -> kind, question numbers and position in the index table
+    indexes = {}
+    skipped = 0
+    for question, answer, category, difficulty in records:
+        question_bytes = question.encode("utf-8")
+        answer_bytes = answer.encode("utf-8")
+        normalized_bytes = normalize_answer(answer).encode("utf-8")
+        difficulty = difficulty.lower()
+        if (
+            not question_bytes
+            or not normalized_bytes
+            or max(map(len, (question_bytes, answer_bytes, normalized_bytes))) > 0xFFFF
+            or difficulty not in DIFFICULTIES
+        ):
+            skipped += 1
+            continue
+
+        number = len(questions)
+        category_index = NO_CATEGORY
+        category = category.lower()
+        if category:
+            kind, numbers, category_index = indexes.setdefault(
+                category, (CATEGORY, [], len(indexes))
+            )
+            numbers.append(number)
+        if difficulty:
+            indexes.setdefault(difficulty, (DIFFICULTY, [], len(indexes)))[1].append(
+                number
+            )
+
+        questions.append(
+            (
+                strings.tell(),
+                len(question_bytes),
+                len(answer_bytes),
+                len(normalized_bytes),
+                category_index,
+                DIFFICULTIES.index(difficulty),
+            )
+        )
+        strings.write(question_bytes + answer_bytes + normalized_bytes)
+    if len(indexes) >= NO_CATEGORY:
+        raise ValueError("Trivia packs can't have more than 65534 categories")
+
+    names = [name.encode("utf-8") for name in indexes]
+    arrays_offset = (
+        PACK_HEADER.size
+        + len(indexes) * PACK_INDEX.size
+        + len(questions) * PACK_QUESTION.size
+    )
+    strings_offset = arrays_offset + sum(
+        len(numbers) * PACK_NUMBER.size for _, numbers, _ in indexes.values()
+    )
+    names_offset = strings_offset + strings.tell()
+
+    # Written next to the pack and swapped in, so a running bot keeps its old mapping
+    temp = Path(f"{path}.tmp")
+    with open(temp, "wb") as file:
+        file.write(
+            PACK_HEADER.pack(PACK_MAGIC, PACK_VERSION, len(questions), len(indexes))
+        )
+        array_offset = arrays_offset
+        name_offset = names_offset
+        for name, (kind, numbers, _) in zip(names, indexes.values()):
+            file.write(
+                PACK_INDEX.pack(
+                    kind, len(name), name_offset, array_offset, len(numbers)
+                )
+            )
+            array_offset += len(numbers) * PACK_NUMBER.size
+            name_offset += len(name)
+        for offset, *rest in questions:
+            file.write(PACK_QUESTION.pack(strings_offset + offset, *rest))
+        for _, numbers, _ in indexes.values():
+            file.write(b"".join(map(PACK_NUMBER.pack, numbers)))
+        file.write(strings.getbuffer())
+        file.write(b"".join(names))
+    os.replace(temp, path)
+    return len(questions), skipped
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        description="Compile CSV or JSON trivia questions into a BrainBot trivia pack"
+    )
+    parser.add_argument("inputs", nargs="+", type=Path, help=".csv/.txt or .json files")
+    parser.add_argument("-o", "--output", type=Path, required=True, help=".tpk file")
+    parser.add_argument(
+        "--category", default="", help="category of questions without one"
+    )
+    parser.add_argument(
+        "--difficulty", default="", help="difficulty of questions without one"
+    )
+    args = parser.parse_args()
+
+    def records():
+        for path in args.inputs:
+            reader = read_json if path.suffix.lower() == ".json" else read_csv
+            yield from reader(path, args.category, args.difficulty)
+
+    written, skipped = write_pack(records(), args.output)
+    print(f"Wrote {written} questions to {args.output}, skipped {skipped}")
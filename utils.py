@@ -1,18 +1,87 @@
-from asyncio import TimeoutError
+import cProfile
+import json
+import pstats
+import re
+import sqlite3
+import tracemalloc
+from array import array
+from asyncio import (
+    Event,
+    PriorityQueue,
+    Queue,
+    Semaphore,
+    TimeoutError,
+    create_task,
+    gather,
+    get_running_loop,
+    shield,
+    sleep,
+    wait_for,
+)
+from bisect import bisect_right
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from glob import glob
+from hashlib import sha256
+from heapq import heappop, heappush
+from inspect import iscoroutinefunction
+from io import BytesIO, StringIO
+from itertools import count
+from mmap import ACCESS_READ, mmap
+from multiprocessing import Pipe, Process
 from os import getenv
 from pathlib import Path
-from random import sample
-from time import time
+from random import randrange
+from threading import local
+from time import monotonic, time
 from typing import List
+from urllib.parse import quote
 
-from aiohttp import BasicAuth, ClientSession, ContentTypeError
+from aiohttp import (
+    BasicAuth,
+    ClientError,
+    ClientResponseError,
+    ClientSession,
+    ClientTimeout,
+    ContentTypeError,
+    TCPConnector,
+)
+from bs4 import BeautifulSoup
+from googletrans import Translator
+import numpy as np
+from py_expression_eval import Expression, Parser
+from metrics import (
+    card_render_seconds,
+    command_calls,
+    command_errors,
+    command_seconds,
+    cooldown_rejections,
+    trace_config,
+)
 from pyryver.objects import Chat, Creator, Notification, Ryver, Task
-from pyryver.util import retry_until_available
+from pyryver.util import TYPE_USER, retry_until_available
 from rich.console import Console
+from trivia import (
+    DIFFICULTIES,
+    NO_CATEGORY,
+    PACK_HEADER,
+    PACK_INDEX,
+    PACK_MAGIC,
+    PACK_NUMBER,
+    PACK_QUESTION,
+    PACK_VERSION,
+    normalize_answer,
+)
 
 from PIL import Image, ImageDraw, ImageFont
 import textwrap
 
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, where evaluations only get the timeout
+    resource = None
+
 # Get a console to log to
 console = Console()
 
@@ -25,8 +94,9 @@ creator = Creator(
     avatar="https://i.imgur.com/VviY54F.png",
 )
 
+
 # Message sender utility to add a bot notice footer and use the bot's creator
-async def send_message(message, chat, footer_end=""):
+async def send_message(message, chat, footer_end="", attachment=None, from_user=None):
     footer = f"I am a bot made by the community. {footer_end}"
     footer = footer.strip().replace(" ", "^ ^")
     footer = f"^{footer}^"
@@ -34,8 +104,245 @@ async def send_message(message, chat, footer_end=""):
     return await chat.send_message(
         f"{message}\n\n{footer}",
         creator=creator,
+        attachment=attachment,
+        from_user=from_user,
     )
 
+
+# Outbound message queue with bounded concurrency, priorities and throttling backoff
+class MessageScheduler:
+    # Lower priorities are delivered first
+    HIGH = 0
+    NORMAL = 1
+    BULK = 2
+
+    def __init__(
+        self,
+        concurrency: int = 4,
+        max_queued: int = 256,
+        max_retries: int = 5,
+        base_backoff: float = 1.0,
+        max_backoff: float = 60.0,
+        on_sent=None,
+    ):
+        self.concurrency = concurrency
+        self.max_queued = max_queued
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.backoff = 0.0
+        # Monotonic time before which no worker sends anything, set when Ryver throttles us
+        self.resume_at = 0.0
+        self.order = count()
+        self.queue = None
+        self.workers = []
+        # Optional callback given (message ID, chat, text) for every delivered message
+        self.on_sent = on_sent
+
+    def start(self):
+        self.queue = PriorityQueue(maxsize=self.max_queued)
+        self.workers = [create_task(self.worker()) for _ in range(self.concurrency)]
+
+    async def send(self, message, chat, footer_end="", priority=NORMAL):
+        """
+        Queue a message and wait until it's delivered, returning its ID like `send_message`.
+
+        Waits for space first if the queue is full, so callers are slowed down instead of
+        piling up unbounded work.
+        """
+        if self.queue is None:
+            self.start()
+        future = get_running_loop().create_future()
+        await self.queue.put(
+            (priority, next(self.order), message, chat, footer_end, future)
+        )
+        return await future
+
+    async def fan_out(self, messages, priority=BULK):
+        """Send (message, chat) pairs in parallel, e.g. a DM to every player."""
+        return await gather(
+            *(self.send(message, chat, priority=priority) for message, chat in messages)
+        )
+
+    async def worker(self):
+        while True:
+            _, _, message, chat, footer_end, future = await self.queue.get()
+            try:
+                if not future.done():
+                    future.set_result(await self.deliver(message, chat, footer_end))
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            finally:
+                self.queue.task_done()
+
+    async def deliver(self, message, chat, footer_end):
+        for attempt in range(self.max_retries + 1):
+            delay = self.resume_at - monotonic()
+            if delay > 0:
+                await sleep(delay)
+            try:
+                result = await send_message(message, chat, footer_end)
+            except ClientResponseError as e:
+                if e.status not in (429, 503) or attempt == self.max_retries:
+                    raise
+                self.throttled(e)
+                continue
+            # Recover gradually so we don't immediately run back into the limit
+            self.backoff /= 2
+            if self.on_sent is not None:
+                self.on_sent(result, chat, message)
+            return result
+
+    def throttled(self, error: ClientResponseError):
+        self.backoff = min(max(self.backoff * 2, self.base_backoff), self.max_backoff)
+        wait = self.backoff
+        try:
+            wait = max(wait, float(error.headers.get("Retry-After")))
+        except (AttributeError, TypeError, ValueError):
+            pass
+        self.resume_at = max(self.resume_at, monotonic() + wait)
+        console.log(f"[yellow]Throttled by Ryver, pausing messages for {wait:.1f}s")
+
+    async def close(self):
+        for worker in self.workers:
+            worker.cancel()
+        self.workers = []
+
+
+# Recent messages by ID, fed from the live session and our own sends, so they can be
+# reacted to directly instead of being fetched from the REST API first
+class MessageCache:
+    def __init__(self, ryver: Ryver, size: int = 1024):
+        self.ryver = ryver
+        self.size = size
+        # Message ID -> (chat, text), least recently used first
+        self.messages = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def add(self, message_id, chat: Chat, text: str = ""):
+        key = str(message_id)
+        self.messages[key] = (chat, text)
+        self.messages.move_to_end(key)
+        if len(self.messages) > self.size:
+            self.messages.popitem(last=False)
+
+    def get(self, message_id):
+        return self.messages.get(str(message_id))
+
+    def __len__(self):
+        return len(self.messages)
+
+    async def react(self, message_id, emoji: str, chat: Chat = None):
+        """
+        React to a message, posting the reaction straight away if the message is cached and
+        only falling back to fetching it from `chat` otherwise.
+        """
+        cached = self.get(message_id)
+        if cached is not None:
+            self.hits += 1
+            url = self.ryver.get_api_url(
+                obj_type=cached[0].get_type(),
+                obj_id=cached[0].get_id(),
+                action="Chat.React()",
+                format="json",
+            )
+            try:
+                # The same authenticated (and instrumented) session pyryver posts with
+                async with self.ryver._session.post(
+                    url, json={"id": str(message_id), "reaction": emoji}
+                ):
+                    return
+            except ClientError as e:
+                console.log(f"[yellow]Reacting to message {message_id} failed: {e}")
+            chat = cached[0]
+        else:
+            self.misses += 1
+
+        if chat is None:
+            return
+        message = await retry_until_available(
+            chat.get_message,
+            str(message_id),
+            timeout=5.0,
+            retry_delay=0.5,
+        )
+        await message.react(emoji)
+
+
+# Captures a CPU or memory profile of the running bot on demand, costing nothing otherwise
+class Profiler:
+    MODES = ("cpu", "memory")
+
+    def __init__(self, top: int = 40, max_seconds: int = 300, frames: int = 10):
+        self.top = top
+        self.max_seconds = max_seconds
+        self.frames = frames
+        self.running = False
+
+    async def capture(self, mode: str = "cpu", seconds: float = 30):
+        """Profile for a number of seconds, returning a text report."""
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown profile mode {mode}")
+        seconds = min(seconds, self.max_seconds)
+        self.running = True
+        try:
+            if mode == "cpu":
+                body = await self.cpu(seconds)
+            else:
+                body = await self.memory(seconds)
+        finally:
+            self.running = False
+        return f"BrainBot {mode} profile over {seconds}s\n\n{body}"
+
+    async def cpu(self, seconds: float):
+        # The profiler sees every task on the loop while this one sleeps
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            await sleep(seconds)
+        finally:
+            profile.disable()
+
+        report = StringIO()
+        stats = pstats.Stats(profile, stream=report)
+        for order in ("tottime", "cumulative"):
+            report.write(f"Top {self.top} functions by {order}\n")
+            stats.sort_stats(order).print_stats(self.top)
+        return report.getvalue()
+
+    async def memory(self, seconds: float):
+        tracemalloc.start(self.frames)
+        try:
+            before = self.snapshot()
+            await sleep(seconds)
+            after = self.snapshot()
+        finally:
+            tracemalloc.stop()
+
+        lines = [f"Top {self.top} allocation sites by growth"]
+        lines += map(str, after.compare_to(before, "lineno")[: self.top])
+        lines += ["", f"Top {self.top} allocation sites by size"]
+        lines += map(str, after.statistics("lineno")[: self.top])
+
+        # Full tracebacks help find who keeps calling into the biggest growers
+        lines += ["", "Tracebacks of the top 5 growing sites"]
+        for stat in after.compare_to(before, "traceback")[:5]:
+            lines += ["", str(stat), *stat.traceback.format()]
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def snapshot():
+        return tracemalloc.take_snapshot().filter_traces(
+            (
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+                tracemalloc.Filter(False, "<unknown>"),
+            )
+        )
+
+
 # Task reminder creator
 async def remind_task(ryver: Ryver, task: Task, minutes: int):
     """
@@ -65,9 +372,143 @@ async def remind_task(ryver: Ryver, task: Task, minutes: int):
         await session.close()
 
 
-# Retrieves poll results and shows it on chat as a reply to the original poll message
-async def show_poll_results(
-    chat: Chat, inputs: List[str], reactions: List[str], poll_id: str, bot_id: str
+# Heap based timer that runs a callback for each key once its due time (epoch seconds) passes
+class TimerScheduler:
+    def __init__(
+        self, callback, retry_delay: float = 30, max_retry_delay: float = 3600
+    ):
+        self.callback = callback
+        self.heap = []
+        # Current due time of every scheduled key, so cancelled or moved timers are skipped
+        self.timers = {}
+        self.changed = Event()
+        # Running callbacks, and how many times in a row each key's callback failed
+        self.tasks = set()
+        self.failures = {}
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+
+    def schedule(self, key, due: float):
+        self.timers[key] = due
+        heappush(self.heap, (due, key))
+        self.changed.set()
+
+    def cancel(self, key):
+        self.timers.pop(key, None)
+        self.failures.pop(key, None)
+
+    def fire(self, key):
+        task = create_task(self.callback(key))
+        self.tasks.add(task)
+        task.add_done_callback(lambda task: self.finished(key, task))
+
+    # Retry failed callbacks with an exponential backoff, unless they were rescheduled
+    def finished(self, key, task):
+        self.tasks.discard(task)
+        if task.cancelled():
+            return
+        error = task.exception()
+        if error is None:
+            self.failures.pop(key, None)
+            return
+        failures = self.failures.get(key, 0)
+        self.failures[key] = failures + 1
+        delay = min(self.retry_delay * 2**failures, self.max_retry_delay)
+        console.log(f"[red]Timer {key} failed, retrying in {delay:.0f}s: {error!r}")
+        if key not in self.timers:
+            self.schedule(key, time() + delay)
+
+    def __len__(self):
+        return len(self.timers)
+
+    async def run(self):
+        while True:
+            now = time()
+            while self.heap and self.heap[0][0] <= now:
+                due, key = heappop(self.heap)
+                if self.timers.get(key) == due:
+                    del self.timers[key]
+                    self.fire(key)
+
+            self.changed.clear()
+            timeout = self.heap[0][0] - now if self.heap else None
+            try:
+                await wait_for(self.changed.wait(), timeout)
+            except TimeoutError:
+                pass
+
+
+# Running vote count of a poll, kept up to date from reaction events
+class PollTally:
+    __slots__ = ("inputs", "reactions", "bot_id", "votes")
+
+    def __init__(self, inputs: List[str], reactions: List[str], bot_id, votes=None):
+        self.inputs = inputs
+        self.reactions = reactions
+        self.bot_id = bot_id
+        # Reaction -> IDs of the users that reacted with it (without the bot)
+        self.votes = {reaction: set() for reaction in reactions}
+        if votes is not None:
+            for reaction, users in votes.items():
+                self.votes[reaction] = set(users)
+
+    def add(self, reaction: str, user_id):
+        if user_id == self.bot_id:
+            return False
+        voters = self.votes.setdefault(reaction, set())
+        if user_id in voters:
+            return False
+        voters.add(user_id)
+        return True
+
+    def remove(self, reaction: str, user_id):
+        voters = self.votes.get(reaction)
+        if voters is None or user_id not in voters:
+            return False
+        voters.remove(user_id)
+        return True
+
+    # Replace the tally with a message's reactions, e.g. to catch up on missed events
+    def resync(self, reactions):
+        self.votes = {reaction: set() for reaction in self.reactions}
+        for reaction, users in reactions.items():
+            self.votes[reaction] = {user for user in users if user != self.bot_id}
+
+    def to_dict(self):
+        return {reaction: list(users) for reaction, users in self.votes.items()}
+
+    def results(self, heading: str = "Poll results"):
+        # Create association between options and their reactions
+        poll_options = {}
+        for i in range(0, len(self.reactions)):
+            poll_options[self.reactions[i]] = self.inputs[i + 1]
+
+        # Get poll number of reactions in count order
+        poll_votes = sorted(
+            ((emoji, len(users)) for emoji, users in self.votes.items()),
+            reverse=True,
+            key=lambda x: x[1],
+        )
+        most_voted = poll_votes[0][1] if poll_votes else 0
+
+        msg_body = "\n## {0}: {1}".format(heading, self.inputs[0])
+
+        for vote_reaction, vote_count in poll_votes:
+            bold = "**" if vote_count == most_voted else ""
+            poll_option = (
+                " {0}".format(poll_options[vote_reaction])
+                if vote_reaction in poll_options
+                else ""
+            )
+            msg_body += "\n{3}{0} : :{1}:{2}{3}".format(
+                vote_count, vote_reaction, poll_option, bold
+            )
+        return msg_body
+
+
+# Builds a poll tally from the poll message, for polls without a live tally
+async def fetch_poll_tally(
+    chat: Chat, inputs: List[str], reactions: List[str], poll_id: str, bot_id
 ):
     console.log("Retrieving poll results")
     try:
@@ -79,44 +520,34 @@ async def show_poll_results(
         )
     except TimeoutError:
         console.log("[red]Failed when trying to retrieve poll message for results")
-        return
-
-    # Create association between options and their reactions
-    poll_options = {}
-    for i in range(0, len(reactions)):
-        poll_options[reactions[i]] = inputs[i + 1]
-
-    # Get poll number of reactions in count order
-    poll_votes = []
-    for emoji, users in message.get_reactions().items():
-        # Remove bot reactions from count
-        users.remove(bot_id)
-        poll_votes.append([emoji, len(users)])
-    poll_votes = sorted(poll_votes, reverse=True, key=lambda x: x[1])
+        return None
 
-    most_voted = poll_votes[0][1]
+    tally = PollTally(inputs, reactions, bot_id)
+    tally.resync(message.get_reactions())
+    return tally
 
-    # Send results
-    msg_body = "\n## Poll results: {0}".format(inputs[0])
 
-    for vote_reaction, vote_count in poll_votes:
-        bold = "**" if vote_count == most_voted else ""
-        poll_option = (
-            " {0}".format(poll_options[vote_reaction])
-            if vote_reaction in poll_options
-            else ""
-        )
-        msg_body += "\n{3}{0} : :{1}:{2}{3}".format(
-            vote_count, vote_reaction, poll_option, bold
-        )
+# Shows poll results on chat
+async def show_poll_results(chat: Chat, tally: PollTally):
     await send_message(
-        msg_body,
+        tally.results(),
         chat,
     )
 
 
-# Sorts notifications and executes suitable actions
-async def handle_notification(ryver: Ryver, notification: Notification, bot_chat: Chat):
+# Sorts notifications and executes suitable actions, returning the ID of a poll that ended
+async def handle_notification(
+    ryver: Ryver,
+    notification: Notification,
+    bot_chat: Chat,
+    tallies=None,
+    bot_id=None,
+    poll_chat=None,
+):
+    """
+    `poll_chat` gets the chat a poll was posted in by its ID, otherwise every poll is
+    taken to be in `bot_chat`.
+    """
     # Check if it's a reminder notification
     if notification.get_predicate() == "reminder_for":
         # Check if it's a task reminder notification:
@@ -128,75 +559,1621 @@ async def handle_notification(ryver: Ryver, notification: Notification, bot_chat
                 console.log(f"Poll {task.get_subject()} has ended")
                 # Poll tasks are saved as "BrainBotPoll#<poll_id>" so there's the poll id
                 poll_id = task.get_subject().replace("BrainBotPoll#", "")
+                chat = poll_chat(poll_id) if poll_chat is not None else bot_chat
+                # Use the live tally if there is one, otherwise count the reactions
+                tally = tallies.get(poll_id) if tallies is not None else None
+                if tally is None:
+                    tally = await fetch_poll_tally(
+                        chat=chat,
+                        inputs=(task.get_body().split(";;")[0]).split(";"),
+                        reactions=(task.get_body().split(";;")[1]).split(";"),
+                        poll_id=poll_id,
+                        bot_id=bot_id or (await ryver.get_info())["me"]["id"],
+                    )
                 # Show poll results
-                await show_poll_results(
-                    chat=bot_chat,
-                    inputs=(task.get_body().split(";;")[0]).split(";"),
-                    reactions=(task.get_body().split(";;")[1]).split(";"),
-                    poll_id=poll_id,
-                    bot_id=(await ryver.get_info())["me"]["id"],
-                )
+                if tally is not None:
+                    await show_poll_results(chat, tally)
                 # Delete poll task
                 console.log("Deleting poll reminder task")
                 await task.delete()
                 # Mark notification as read (Pyryver doesn't support removing notifications yet)
                 console.log("Marking reminder notification as read")
                 await notification.set_status(unread=False, new=False)
+                return poll_id
 
     else:
         # Discard irrelevant notifications
         await notification.set_status(unread=False, new=False)
 
 
-# Cooldown utility
-class Cooldown:
-    def __init__(self, seconds: int):
+# Filters, processes and marks notifications read in bulk instead of one by one
+class NotificationPipeline:
+    def __init__(self, ryver: Ryver, handler, concurrency: int = 8):
+        self.ryver = ryver
+        # Coroutine called with every relevant Notification
+        self.handler = handler
+        self.semaphore = Semaphore(concurrency)
+        # Irrelevant notifications waiting to be marked as read
+        self.unread = 0
+        # Relevant notifications whose handler failed, kept unread so they're retried on
+        # the next startup
+        self.failed = []
+        # IDs of live notifications that couldn't be fetched yet, which stop everything
+        # from being marked read until they're handled
+        self.unfetched = []
+
+    # Only task reminders (used for polls) need any work, everything else is just read
+    @staticmethod
+    def relevant(predicate, entity_type=None):
+        return predicate == "reminder_for" and entity_type in (
+            None,
+            "Entity.Tasks.Task",
+        )
+
+    async def process(self, notification: Notification):
+        async with self.semaphore:
+            try:
+                await self.handler(notification)
+            except Exception as e:
+                console.log(f"[red]Failed to handle notification: {e!r}")
+                self.failed.append(notification)
+
+    async def drain(self, notifications):
+        """
+        Handle an async iterable of notifications, e.g. everything unread at startup.
+        Every page is read before anything is marked read, which would shift the pages.
+        """
+        try:
+            fetched = [notification async for notification in notifications]
+        except ClientError as e:
+            console.log(f"[red]Failed to fetch unread notifications: {e!r}")
+            return
+        tasks = []
+        skipped = 0
+        for notification in fetched:
+            if self.relevant(
+                notification.get_predicate(), notification.get_object_entity_type()
+            ):
+                tasks.append(create_task(self.process(notification)))
+            else:
+                skipped += 1
+        await gather(*tasks)
+        self.unread += skipped
+        console.log(f"Handled {len(tasks)} unread notifications and skipped {skipped}")
+        await self.mark_read()
+
+    async def on_event(self, data: dict):
+        """Handle a /api/notify event, skipping the fetch when its payload shows it's irrelevant."""
+        predicate = data.get("predicate")
+        if predicate is not None and not self.relevant(predicate):
+            self.unread += 1
+            return
+        await self.fetch(data.get("id"))
+
+    async def fetch(self, notification_id):
+        """Fetch and handle a notification, remembering it for later if the fetch fails."""
+        try:
+            notification = await Notification.get_by_id(
+                self.ryver, obj_id=notification_id
+            )
+        except ClientResponseError as e:
+            if e.status == 404:
+                return
+            self.unfetched.append(notification_id)
+            return
+        except ClientError:
+            self.unfetched.append(notification_id)
+            return
+        await self.process(notification)
+
+    async def mark_read(self):
+        # Marking everything read would drop notifications that were never fetched
+        unfetched, self.unfetched = self.unfetched, []
+        for notification_id in unfetched:
+            await self.fetch(notification_id)
+        if self.unfetched:
+            console.log(
+                f"[yellow]Not marking notifications read until {len(self.unfetched)} "
+                "more are fetched"
+            )
+            return
+
+        # Relevant notifications are handled by their ID whether they're read or not,
+        # so it's safe to mark everything read at once here, as long as the ones that
+        # failed are marked unread again afterwards
+        if self.unread:
+            self.unread = 0
+            await self.ryver.mark_all_notifs_read()
+        failed, self.failed = self.failed, []
+        for notification in failed:
+            try:
+                await notification.set_status(unread=True, new=False)
+            except ClientError as e:
+                console.log(f"[red]Failed to keep a notification unread: {e!r}")
+                self.failed.append(notification)
+
+    async def autoflush(self, interval: float = 10.0):
+        while True:
+            await sleep(interval)
+            await self.mark_read()
+
+
+# Token bucket rate limiter for a single command
+class RateLimiter:
+    def __init__(self, seconds: float, burst: int = 1, max_entries: int = 10000):
+        # One use is refilled every `seconds`, and up to `burst` uses can be saved up
         self.cooldown = seconds
-        self.last_used = {}
+        self.burst = burst
+        self.max_entries = max_entries
+        # Seconds for an empty bucket to fill up again, after which it can be forgotten
+        self.idle = seconds * burst
+        # username -> (tokens, last update), ordered from least to most recently used
+        self.buckets = OrderedDict()
+
+    def tokens(self, username, now: float):
+        bucket = self.buckets.get(username)
+        if bucket is None:
+            return float(self.burst)
+        tokens, updated = bucket
+        if self.cooldown <= 0:
+            return float(self.burst)
+        return min(self.burst, tokens + (now - updated) / self.cooldown)
+
+    # Forget buckets that have been idle long enough to be full again
+    def evict(self, now: float):
+        buckets = self.buckets
+        while buckets:
+            username, (tokens, updated) = next(iter(buckets.items()))
+            if now - updated < self.idle and len(buckets) <= self.max_entries:
+                break
+            del buckets[username]
 
     def run(self, username=None, bypass=False):
-        if username not in self.last_used:
-            self.last_used[username] = 0
-        if time() - self.last_used[username] >= self.cooldown or bypass:
-            self.last_used[username] = time()
-            return True
+        now = monotonic()
+        tokens = self.tokens(username, now)
+
+        if tokens >= 1:
+            tokens -= 1
+        elif bypass:
+            tokens = 0.0
+        else:
+            return False
+
+        self.buckets[username] = (tokens, now)
+        self.buckets.move_to_end(username)
+        self.evict(now)
+        return True
+
+    # Bucket state with wall clock timestamps, since monotonic time doesn't survive restarts
+    def snapshot(self):
+        offset = time() - monotonic()
+        return [
+            [username, tokens, updated + offset]
+            for username, (tokens, updated) in self.buckets.items()
+        ]
+
+    def restore(self, snapshot):
+        offset = time() - monotonic()
+        now = monotonic()
+        for username, tokens, updated in snapshot:
+            self.buckets[username] = (float(tokens), updated - offset)
+        self.evict(now)
+
+
+# Per command rate limits loaded from brainbot.ini, optionally saved across restarts
+class RateLimits:
+    def __init__(self, config, path=None):
+        self.config = config
+        self.path = Path(path) if path is not None else None
+        self.limits = {}
+
+    def get(self, name: str, fallback: float):
+        """Create the limiter for a command from its [cooldowns] and [bursts] settings."""
+        limiter = RateLimiter(
+            self.config.getfloat("cooldowns", name, fallback=fallback),
+            burst=self.config.getint("bursts", name, fallback=1),
+        )
+        self.limits[name] = limiter
+        return limiter
+
+    def load(self):
+        if self.path is None:
+            return
+        try:
+            with open(self.path) as file:
+                snapshot = json.load(file)
+        except (OSError, ValueError):
+            return
+        for name, buckets in snapshot.items():
+            if name in self.limits:
+                self.limits[name].restore(buckets)
+        console.log("Restored rate limits")
+
+    def save(self):
+        if self.path is None:
+            return
+        snapshot = {name: limit.snapshot() for name, limit in self.limits.items()}
+        temporary = self.path.with_suffix(".tmp")
+        with open(temporary, "w") as file:
+            json.dump(snapshot, file)
+        temporary.replace(self.path)
+
+    async def autosave(self, interval: float = 60.0):
+        while True:
+            await sleep(interval)
+            self.save()
+
+
+# TTL cache for user, chat and account lookups, with hit and miss counters
+class IdentityCache:
+    def __init__(self, ryver: Ryver, ttl: float = 60 * 60):
+        self.ryver = ryver
+        self.ttl = ttl
+        # (kind, key) -> (value, expiry)
+        self.entries = {}
+        self.info = None
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, kind: str, key, loader):
+        now = monotonic()
+        cached = self.entries.get((kind, key))
+        if cached is not None and cached[1] > now:
+            self.hits += 1
+            return cached[0]
+
+        self.misses += 1
+        value = loader()
+        # Don't cache misses, the user or chat might just not be loaded yet
+        if value is not None:
+            self.entries[(kind, key)] = (value, now + self.ttl)
+        return value
+
+    def user(self, id=None, jid=None, username=None):
+        if jid is not None:
+            return self.lookup("jid", jid, lambda: self.ryver.get_user(jid=jid))
+        if username is not None:
+            return self.lookup(
+                "username", username, lambda: self.ryver.get_user(username=username)
+            )
+        return self.lookup("user", id, lambda: self.ryver.get_user(id=id))
+
+    def chat(self, id):
+        return self.lookup("chat", id, lambda: self.ryver.get_chat(id=id))
+
+    # Get the DM chat of a user by username
+    def dm(self, username: str):
+        user = self.user(username=username)
+        return self.chat(user.get_id()) if user is not None else None
+
+    async def get_info(self):
+        if self.info is None:
+            self.misses += 1
+            self.info = await self.ryver.get_info()
         else:
+            self.hits += 1
+        return self.info
+
+    def invalidate_user(self, user_id=None):
+        """Forget a user (or every user if no ID is given) after their details changed."""
+        for key, (value, _) in list(self.entries.items()):
+            # Chats are kept, except for the user's DM, which is the User itself
+            if key[0] == "chat" and value.get_type() != TYPE_USER:
+                continue
+            if user_id is None or value.get_id() == user_id:
+                del self.entries[key]
+        if user_id is None or (
+            self.info is not None and self.info["me"]["id"] == user_id
+        ):
+            self.info = None
+
+    async def refresh_user(self, user_id: int, change: str = "updated"):
+        """
+        Reload a user after their details changed. pyryver's lookups only search the
+        users it loaded at startup, so the user is replaced there before it's forgotten.
+        """
+        users = [user for user in self.ryver.users if user.get_id() != user_id]
+        if change != "deleted":
+            try:
+                users.append(await self.ryver.get_object(TYPE_USER, user_id))
+            except (ClientError, KeyError):
+                console.log(f"[red]Could not reload user {user_id}")
+                return
+        self.ryver.users = users
+        self.invalidate_user(user_id)
+
+
+# A single registered chat command
+class Command:
+    __slots__ = (
+        "name",
+        "handler",
+        "cooldown",
+        "per_user",
+        "admin",
+        "bypass",
+        "react",
+        "usage",
+    )
+
+    def __init__(self, name, handler, cooldown, per_user, admin, bypass, react, usage):
+        self.name = name
+        self.handler = handler
+        self.cooldown = cooldown
+        self.per_user = per_user
+        self.admin = admin
+        self.bypass = bypass
+        self.react = react
+        self.usage = usage
+
+
+# Everything a command handler needs to know about the message that invoked it
+class CommandContext:
+    __slots__ = ("msg", "chat", "user", "command", "args")
+
+    def __init__(self, msg, chat: Chat, user, command: Command, args: str):
+        self.msg = msg
+        self.chat = chat
+        self.user = user
+        self.command = command
+        # Message text after the command name, with the original casing
+        self.args = args
+
+    @property
+    def username(self):
+        return self.user.get_username()
+
+
+# Routes chat messages to their handlers with a single dict lookup
+class CommandRegistry:
+    def __init__(self, identities: IdentityCache, admins=()):
+        self.identities = identities
+        self.admins = admins
+        # Single word triggers (e.g. "!topic") mapped to their command
+        self.commands = {}
+        # Two word commands without arguments (e.g. "!poll status"), by first word and
+        # then second word
+        self.subcommands = {}
+        # Other multi word triggers (e.g. "someone tell me to") checked by prefix
+        self.phrases = []
+        # First characters of every trigger, used to drop chatter early
+        self.initials = set()
+        self.cooldown_handler = None
+
+    def command(
+        self,
+        name: str,
+        *aliases: str,
+        cooldown: RateLimiter = None,
+        per_user: bool = False,
+        admin: bool = False,
+        bypass: bool = False,
+        react: bool = False,
+        usage: str = None,
+    ):
+        """
+        Register the decorated coroutine as the handler for `name` and its aliases.
+
+        `cooldown` is checked before the handler runs, per user if `per_user` is set.
+        Admins can skip it with "<name> bypass" if `bypass` is set, and `react` marks
+        rejected messages with the cooldown reaction. `admin` restricts the command to
+        bot admins, and `usage` is sent instead of running the handler with no arguments.
+        """
+
+        def decorator(handler):
+            command = Command(
+                name, handler, cooldown, per_user, admin, bypass, react, usage
+            )
+            for trigger in (name, *aliases):
+                trigger = trigger.lower()
+                first, _, rest = trigger.partition(" ")
+                if rest and first[0] == "!" and " " not in rest:
+                    self.subcommands.setdefault(first, {})[rest] = command
+                elif rest:
+                    self.phrases.append((trigger, command))
+                else:
+                    self.commands[trigger] = command
+                self.initials.add(trigger[0])
+            return handler
+
+        return decorator
+
+    def on_cooldown(self, handler):
+        """Register the coroutine called for messages rejected by a `react` cooldown."""
+        self.cooldown_handler = handler
+        return handler
+
+    def match(self, text: str):
+        """Find the command for a message, returning it with its arguments."""
+        if not text or text[0].lower() not in self.initials:
+            return None, None
+
+        parts = text.split(None, 1)
+        token = parts[0].lower()
+        args = parts[1] if len(parts) > 1 else ""
+
+        # Two word commands take no arguments, so "!poll Status report?;yes;no" is a
+        # poll rather than "!poll status"
+        subcommands = self.subcommands.get(token)
+        if subcommands is not None and args and len(args.split()) == 1:
+            command = subcommands.get(args.strip().lower())
+            if command is not None:
+                return command, ""
+
+        command = self.commands.get(token)
+        if command is not None:
+            return command, args
+
+        lowered = text.lower()
+        for phrase, command in self.phrases:
+            if not lowered.startswith(phrase):
+                continue
+            rest = text[len(phrase) :]
+            # The phrase has to end at a word boundary ("someone tell me tomorrow" isn't
+            # "someone tell me to ...") and be followed by something, a bare phrase is
+            # just chat
+            if rest[:1].isspace() and rest.strip():
+                return command, rest.strip()
+
+        return None, None
+
+    async def dispatch(self, msg, chat: Chat):
+        """Run the handler for a chat message, returning whether it was a command."""
+        command, args = self.match(msg.text)
+        if command is None:
             return False
 
+        user = self.identities.user(jid=msg.from_jid)
+        username = user.get_username()
+        ctx = CommandContext(msg, chat, user, command, args)
+
+        if command.admin and user not in self.admins:
+            console.log(f"[bold red]{username} attempted to use {command.name}")
+            return True
+
+        if command.usage is not None and not args:
+            await send_message(command.usage, chat)
+            return True
+
+        if command.cooldown is not None:
+            first, _, rest = args.partition(" ")
+            if command.bypass and first.lower() == "bypass":
+                if user not in self.admins:
+                    console.log(
+                        f"[bold red]{username} attempted to bypass the {command.name} cooldown"
+                    )
+                    return True
+                console.log(
+                    f"{username} used the {command.name} command [bold red](COOLDOWN BYPASS)"
+                )
+                command.cooldown.run(
+                    username=username if command.per_user else None, bypass=True
+                )
+                ctx.args = rest.strip()
+            elif not command.cooldown.run(
+                username=username if command.per_user else None
+            ):
+                console.log("Cancelled due to cooldown")
+                cooldown_rejections.inc(command=command.name)
+                if command.react and self.cooldown_handler is not None:
+                    await self.cooldown_handler(ctx)
+                return True
+
+        started = monotonic()
+        try:
+            await command.handler(ctx)
+        except Exception:
+            command_errors.inc(command=command.name)
+            raise
+        finally:
+            command_calls.inc(command=command.name)
+            command_seconds.observe(monotonic() - started, command=command.name)
+        return True
+
+
+# Raised when an outbound web lookup fails or times out
+class WebLookupError(Exception):
+    pass
+
+
+# Shared, connection pooled HTTP client for web lookups
+class WebClient:
+    def __init__(
+        self,
+        limit: int = 20,
+        limit_per_host: int = 4,
+        connect_timeout: float = 5.0,
+        read_timeout: float = 10.0,
+        max_size: int = 2 * 1024 * 1024,
+        user_agent: str = "BrainBot",
+    ):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.timeout = ClientTimeout(
+            total=connect_timeout + read_timeout,
+            sock_connect=connect_timeout,
+            sock_read=read_timeout,
+        )
+        self.max_size = max_size
+        self.headers = {"User-Agent": user_agent}
+        self.session = None
+
+    # The session has to be created inside the running event loop, so it's made on first use
+    def get_session(self):
+        if self.session is None or self.session.closed:
+            self.session = ClientSession(
+                connector=TCPConnector(
+                    limit=self.limit, limit_per_host=self.limit_per_host
+                ),
+                timeout=self.timeout,
+                headers=self.headers,
+                trace_configs=[trace_config()],
+            )
+        return self.session
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def fetch(self, url: str):
+        """
+        GET a URL, returning its status code and body.
+
+        Bodies over `max_size` bytes are truncated, and network errors and timeouts are
+        raised as `WebLookupError`.
+        """
+        try:
+            async with self.get_session().get(url) as resp:
+                body = bytearray()
+                async for chunk in resp.content.iter_chunked(64 * 1024):
+                    body += chunk
+                    if len(body) >= self.max_size:
+                        console.log(
+                            f"[yellow]Response from {url} truncated to {self.max_size} bytes"
+                        )
+                        del body[self.max_size :]
+                        break
+                return resp.status, bytes(body)
+        except (ClientError, TimeoutError) as e:
+            raise WebLookupError(f"Lookup of {url} failed: {e!r}") from e
+
+    # Run a blocking function (e.g. an HTML parser) in a worker thread
+    async def run_blocking(self, func, *args):
+        return await get_running_loop().run_in_executor(None, func, *args)
+
+
+# googletrans clients aren't safe to share between threads, so each worker gets its own
+translators = local()
+
+
+# Translation backends take the text and destination language and return the translation
+def google_translate(text: str, dest: str):
+    if not hasattr(translators, "client"):
+        translators.client = Translator()
+    return translators.client.translate(text, dest=dest).text
+
+
+# Offline backend for testing and benchmarks
+def stub_translate(text: str, dest: str):
+    return f"[{dest}] {text}"
+
+
+TRANSLATION_BACKENDS = {"google": google_translate, "stub": stub_translate}
+
+
+# Runs translations off the event loop with an LRU+TTL cache, timeouts and coalescing
+class TranslationService:
+    def __init__(
+        self,
+        backend=google_translate,
+        workers: int = 4,
+        timeout: float = 10.0,
+        ttl: float = 24 * 60 * 60,
+        size: int = 512,
+    ):
+        self.backend = backend
+        # Blocking backends get their own threads so they can't starve other executor work
+        self.pool = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="translate"
+        )
+        self.timeout = timeout
+        self.ttl = ttl
+        self.size = size
+        # (text, language) -> (translation, monotonic expiry), least recently used first
+        self.cache = OrderedDict()
+        # Translations in progress, so identical concurrent requests share one backend call
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def translate(self, text: str, dest: str):
+        """
+        Translate text, raising TimeoutError if the backend takes too long.
+
+        A timed out translation keeps running in the background and is cached when done.
+        """
+        key = (text.strip(), dest.lower())
+        cached = self.cache.get(key)
+        if cached is not None:
+            if cached[1] > monotonic():
+                self.hits += 1
+                self.cache.move_to_end(key)
+                return cached[0]
+            del self.cache[key]
+
+        self.misses += 1
+        task = self.pending.get(key)
+        if task is None:
+            task = self.pending[key] = create_task(self.call(key))
+            task.add_done_callback(lambda done: self.finished(key, done))
+        # Shielded so one caller timing out doesn't cancel it for the others
+        return await wait_for(shield(task), self.timeout)
+
+    async def call(self, key):
+        if iscoroutinefunction(self.backend):
+            translation = await self.backend(*key)
+        else:
+            translation = await get_running_loop().run_in_executor(
+                self.pool, self.backend, *key
+            )
+        self.cache[key] = (translation, monotonic() + self.ttl)
+        if len(self.cache) > self.size:
+            self.cache.popitem(last=False)
+        return translation
+
+    def finished(self, key, task):
+        self.pending.pop(key, None)
+        # Mark failures as retrieved in case every caller already timed out
+        if not task.cancelled():
+            task.exception()
+
+    def close(self):
+        self.pool.shutdown(wait=False)
+
+
+MW_DICTIONARY_URL = "https://www.merriam-webster.com/dictionary/"
+MW_THESAURUS_URL = "https://www.merriam-webster.com/thesaurus/"
+
+
+# Get the first definition from a Merriam-Webster dictionary page
+def parse_definition(html: bytes):
+    definition = BeautifulSoup(html, "lxml").find("span", class_="dtText")
+    return definition.get_text() if definition is not None else None
+
+
+# Get the synonym list from a Merriam-Webster thesaurus page
+def parse_synonyms(html: bytes):
+    synonyms = BeautifulSoup(html, "lxml").find(class_="mw-list")
+    return synonyms.get_text().strip("SYNONYMS") if synonyms is not None else None
+
+
+# Two tier (in-memory LRU over SQLite) cache of parsed word lookups
+class LookupCache:
+    # Returned by get() when a word isn't cached, since None is a cacheable "no results"
+    MISSING = object()
+
+    def __init__(
+        self,
+        path=bot_dir / "lookups.db",
+        ttl: float = 7 * 24 * 60 * 60,
+        negative_ttl: float = 60 * 60,
+        size: int = 512,
+    ):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.size = size
+        self.memory = OrderedDict()
+
+        self.db = sqlite3.connect(str(path))
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS lookups ("
+            "kind TEXT NOT NULL, word TEXT NOT NULL, value TEXT, expires REAL NOT NULL, "
+            "PRIMARY KEY (kind, word))"
+        )
+        self.db.execute("DELETE FROM lookups WHERE expires < ?", (time(),))
+        self.db.commit()
+
+    @staticmethod
+    def normalize(word: str):
+        return " ".join(word.lower().split())
+
+    def remember(self, key, value, expires):
+        self.memory[key] = (value, expires)
+        self.memory.move_to_end(key)
+        if len(self.memory) > self.size:
+            self.memory.popitem(last=False)
+
+    def get(self, kind: str, word: str):
+        key = (kind, self.normalize(word))
+        now = time()
+
+        cached = self.memory.get(key)
+        if cached is not None:
+            if cached[1] > now:
+                self.memory.move_to_end(key)
+                return cached[0]
+            del self.memory[key]
+
+        row = self.db.execute(
+            "SELECT value, expires FROM lookups WHERE kind = ? AND word = ?", key
+        ).fetchone()
+        if row is None or row[1] <= now:
+            return self.MISSING
+        self.remember(key, row[0], row[1])
+        return row[0]
+
+    def set(self, kind: str, word: str, value):
+        """Cache a lookup result, using the shorter negative TTL when `value` is None."""
+        key = (kind, self.normalize(word))
+        expires = time() + (self.ttl if value is not None else self.negative_ttl)
+        self.remember(key, value, expires)
+        self.db.execute(
+            "INSERT OR REPLACE INTO lookups VALUES (?, ?, ?, ?)", (*key, value, expires)
+        )
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+# Look a word up on Merriam-Webster, returning None when there are no results
+async def lookup_word(
+    client: WebClient, base_url: str, parser, word: str, cache: LookupCache = None
+):
+    if cache is not None:
+        cached = cache.get(base_url, word)
+        if cached is not LookupCache.MISSING:
+            return cached
+
+    status, body = await client.fetch(base_url + quote(word))
+    if status == 200:
+        result = await client.run_blocking(parser, body)
+    elif status == 404:
+        result = None
+    else:
+        # Don't cache server errors or rate limiting as "no results"
+        return None
+
+    if cache is not None:
+        cache.set(base_url, word, result)
+    return result
+
+
+# Parse an expression, or reuse it if the same (normalized) text was parsed recently
+def parse_cached(parser: Parser, parsed: OrderedDict, text: str, size: int):
+    key = " ".join(text.split())
+    expression = parsed.get(key)
+    if expression is not None:
+        parsed.move_to_end(key)
+        return expression
+    try:
+        expression = parser.parse(key)
+    except Exception:
+        return None
+    parsed[key] = expression
+    if len(parsed) > size:
+        parsed.popitem(last=False)
+    return expression
+
+
+# Evaluate an expression with one value per variable, returning a (status, value) tuple
+# that can be sent back from a worker process
+def evaluate_expression(
+    parser: Parser, parsed: OrderedDict, text: str, values, size: int
+):
+    expression = parse_cached(parser, parsed, text, size)
+    if expression is None:
+        return "parse_error", None
+
+    variables = expression.variables()
+    if len(values) != len(variables):
+        return "variables", len(variables)
+    try:
+        result = expression.evaluate(
+            dict(zip(variables, [float(value) for value in values]))
+        )
+        return "result", str(result)
+    except Exception:
+        return "eval_error", None
+
+
+def append_argument(a, b):
+    return a + [b] if isinstance(a, list) else [a, b]
+
+
+# NumPy versions of py_expression_eval's operators and functions, so a parsed expression
+# can be evaluated over whole arrays in one pass
+VECTOR_OPS1 = {
+    "sin": np.sin,
+    "cos": np.cos,
+    "tan": np.tan,
+    "asin": np.arcsin,
+    "acos": np.arccos,
+    "atan": np.arctan,
+    "sind": lambda a: np.sin(np.radians(a)),
+    "cosd": lambda a: np.cos(np.radians(a)),
+    "tand": lambda a: np.tan(np.radians(a)),
+    "asind": lambda a: np.degrees(np.arcsin(a)),
+    "acosd": lambda a: np.degrees(np.arccos(a)),
+    "atand": lambda a: np.degrees(np.arctan(a)),
+    "sqrt": np.sqrt,
+    "abs": np.abs,
+    "ceil": np.ceil,
+    "floor": np.floor,
+    "round": np.round,
+    "-": np.negative,
+    "not": np.logical_not,
+    "exp": np.exp,
+}
+VECTOR_OPS2 = {
+    "+": np.add,
+    "-": np.subtract,
+    "*": np.multiply,
+    "/": np.divide,
+    "%": np.mod,
+    "^": np.power,
+    "**": np.power,
+    ",": append_argument,
+    "==": np.equal,
+    "!=": np.not_equal,
+    ">": np.greater,
+    "<": np.less,
+    ">=": np.greater_equal,
+    "<=": np.less_equal,
+    "and": np.logical_and,
+    "or": np.logical_or,
+    "xor": np.logical_xor,
+}
+VECTOR_FUNCTIONS = {
+    "log": lambda a, base=None: np.log(a) if base is None else np.log(a) / np.log(base),
+    # np.minimum/np.maximum are binary (a third argument is their out= buffer), so reduce
+    # over every argument. Like the scalar min/max, a lone number is an error
+    "min": lambda a, b, *rest: np.minimum.reduce(np.broadcast_arrays(a, b, *rest)),
+    "max": lambda a, b, *rest: np.maximum.reduce(np.broadcast_arrays(a, b, *rest)),
+    "pyt": np.hypot,
+    "pow": np.power,
+    "atan2": np.arctan2,
+    "if": np.where,
+}
+
+# "start..stop" or "start..stop step size", stop included
+VALUE_RANGE = re.compile(r"^(\S+?)\s*\.\.\s*(\S+?)(?:\s+step\s+(\S+))?$")
+
+
+def parse_values(spec: str, max_points: int):
+    """Parse a range or a comma separated list of numbers into an array."""
+    match = VALUE_RANGE.match(spec)
+    if match is None:
+        values = [float(value) for value in spec.split(",")]
+        if len(values) > max_points:
+            raise OverflowError
+        return np.array(values)
+
+    start, stop = float(match[1]), float(match[2])
+    step = float(match[3]) if match[3] is not None else 1.0
+    if step == 0 or (stop - start) / step < 0:
+        raise ValueError(spec)
+    # Count the points first so a tiny step can't allocate a huge array
+    points = int((stop - start) / step + 1e-9) + 1
+    if points > max_points:
+        raise OverflowError
+    return start + np.arange(points) * step
+
+
+def format_number(value):
+    return f"{value:.10g}"
+
+
+# Evaluate an expression over every combination of the given values ("x=0..10 step 2",
+# "y=1,2,3"), returning ("table", (rows, markdown table or None if too long, CSV))
+def evaluate_table(
+    parser: Parser,
+    parsed: OrderedDict,
+    text: str,
+    specs,
+    size: int,
+    max_points: int,
+    max_rows: int,
+):
+    expression = parse_cached(parser, parsed, text, size)
+    if expression is None:
+        return "parse_error", None
+
+    ranges = {}
+    for spec in specs:
+        name, _, values = spec.partition("=")
+        try:
+            ranges[name.strip()] = parse_values(values.strip(), max_points)
+        except OverflowError:
+            return "too_many", max_points
+        except ValueError:
+            return "range_error", spec
+
+    variables = expression.variables()
+    if sorted(ranges) != sorted(variables):
+        return "missing", ", ".join(variables)
+    points = 1
+    for values in ranges.values():
+        points *= len(values)
+    if points > max_points:
+        return "too_many", max_points
+
+    columns = [
+        grid.ravel()
+        for grid in np.meshgrid(*(ranges[name] for name in variables), indexing="ij")
+    ]
+    vectorized = Expression(
+        expression.tokens, VECTOR_OPS1, VECTOR_OPS2, VECTOR_FUNCTIONS
+    )
+    try:
+        with np.errstate(all="ignore"):
+            result = vectorized.evaluate(dict(zip(variables, columns)))
+            result = np.broadcast_to(np.asarray(result, dtype=float), (points,))
+    except Exception:
+        return "eval_error", None
+    columns.append(result)
+
+    header = [*variables, "result"]
+    csv = StringIO()
+    np.savetxt(
+        csv,
+        np.column_stack(columns),
+        fmt="%.10g",
+        delimiter=",",
+        header=",".join(header),
+        comments="",
+    )
+
+    table = None
+    if points <= max_rows:
+        lines = ["| " + " | ".join(header) + " |", "|" + "---|" * len(header)]
+        for row in zip(*columns):
+            lines.append("| " + " | ".join(map(format_number, row)) + " |")
+        table = "\n".join(lines)
+    return "table", (points, table, csv.getvalue())
+
+
+def address_space():
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[0]) * resource.getpagesize()
+    except OSError:
+        return None
+
+
+# Loop run by each evaluation worker process
+def evaluation_worker(
+    conn,
+    cpu_seconds: int,
+    memory: int,
+    cache_size: int,
+    table_points: int,
+    table_rows: int,
+):
+    if resource is not None:
+        # The worker starts as a copy of the bot, so only cap what it allocates on top
+        baseline = address_space()
+        if baseline is not None:
+            limit = baseline + memory
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+        _, cpu_hard = resource.getrlimit(resource.RLIMIT_CPU)
+
+    parser = Parser()
+    parsed = OrderedDict()
+    while True:
+        try:
+            kind, text, values = conn.recv()
+        except EOFError:
+            return
+        if resource is not None:
+            # The CPU limit counts the worker's whole life, so move it for every request
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            limit = int(usage.ru_utime + usage.ru_stime) + 1 + cpu_seconds
+            if cpu_hard != resource.RLIM_INFINITY:
+                limit = min(limit, cpu_hard)
+            resource.setrlimit(resource.RLIMIT_CPU, (limit, cpu_hard))
+        if kind == "table":
+            reply = evaluate_table(
+                parser, parsed, text, values, cache_size, table_points, table_rows
+            )
+        else:
+            reply = evaluate_expression(parser, parsed, text, values, cache_size)
+        conn.send(reply)
+
+
+# Evaluates math expressions in worker processes with CPU and memory limits, killing and
+# replacing any worker that runs past the timeout so one expression can't take down the bot
+class ExpressionSandbox:
+    def __init__(
+        self,
+        workers: int = 2,
+        timeout: float = 2.0,
+        cpu_seconds: int = 2,
+        memory: int = 128 * 1024 * 1024,
+        cache_size: int = 256,
+        table_points: int = 100000,
+        table_rows: int = 20,
+    ):
+        self.workers = workers
+        self.timeout = timeout
+        self.cpu_seconds = cpu_seconds
+        self.memory = memory
+        self.cache_size = cache_size
+        self.table_points = table_points
+        self.table_rows = table_rows
+        # Idle (process, connection) pairs, filled on first use
+        self.idle = None
+        self.processes = set()
+
+    def spawn(self):
+        conn, child_conn = Pipe()
+        process = Process(
+            target=evaluation_worker,
+            args=(
+                child_conn,
+                self.cpu_seconds,
+                self.memory,
+                self.cache_size,
+                self.table_points,
+                self.table_rows,
+            ),
+            daemon=True,
+        )
+        process.start()
+        child_conn.close()
+        self.processes.add(process)
+        return process, conn
+
+    def kill(self, process, conn):
+        process.kill()
+        process.join()
+        conn.close()
+        self.processes.discard(process)
+
+    async def evaluate(self, text: str, values):
+        """
+        Evaluate an expression, returning ("result", text), ("parse_error", None),
+        ("variables", expected count), ("eval_error", None) or ("limit", None) if the
+        expression took too long or too much memory.
+        """
+        return await self.request("point", text, values)
+
+    async def table(self, text: str, specs):
+        """
+        Evaluate an expression over ranges of values like "x=0..100 step 5" or "y=1,2,3",
+        returning ("table", (rows, markdown table or None, CSV)) or an error status like
+        `evaluate`, ("missing", variable names), ("range_error", spec) or
+        ("too_many", max points).
+        """
+        return await self.request("table", text, specs)
+
+    async def request(self, kind: str, text: str, values):
+        if self.idle is None:
+            self.idle = Queue()
+            for _ in range(self.workers):
+                self.idle.put_nowait(self.spawn())
+
+        process, conn = await self.idle.get()
+        reply = None
+        try:
+            conn.send((kind, text, list(values)))
+            if await get_running_loop().run_in_executor(None, conn.poll, self.timeout):
+                reply = conn.recv()
+        except (EOFError, OSError):
+            # The worker died, e.g. killed for going over its CPU limit
+            pass
+        finally:
+            # A worker left mid-request (timed out, died or the caller was cancelled)
+            # would answer the next request with this one's reply, so replace it
+            if reply is None:
+                console.log(f"[red]Killing evaluation worker {process.pid}")
+                self.kill(process, conn)
+                self.idle.put_nowait(self.spawn())
+            else:
+                self.idle.put_nowait((process, conn))
+        return reply if reply is not None else ("limit", None)
+
+    def close(self):
+        for process in list(self.processes):
+            process.kill()
+        self.processes.clear()
+
+
+# Card template and font for the current render worker, loaded once by its initializer
+card_template = None
+card_font = None
+
+
+def init_card_worker(template: str, font: str, font_size: int):
+    global card_template, card_font
+    card_template = Image.open(template)
+    card_template.load()
+    card_font = ImageFont.truetype(font, size=font_size)
+
+
+# Draw a card's text on a copy of the template and return it as PNG bytes
+def render_card(text: str, wrap_width: int, line_height: int):
+    img = card_template.copy()
+    draw = ImageDraw.Draw(img)
+
+    offset = 0
+    for line in textwrap.wrap(text, width=wrap_width):
+        draw.text((160, 160 + offset), line, font=card_font)
+        offset += line_height
+
+    buffer = BytesIO()
+    img.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+# Renders CAH black cards in a process pool so Pillow never blocks the event loop
 class ImageGenerator:
-    def __init__(self):
-        self.src = "blackTemplate.png"
+    def __init__(
+        self,
+        workers: int = 1,
+        template=bot_dir / "blackTemplate.png",
+        font=bot_dir / "Helvetica-Bold.ttf",
+        font_size: int = 120,
+        wrap_width: int = 17,
+        line_height: int = 140,
+    ):
+        self.template = str(template)
+        self.font = str(font)
+        self.font_size = font_size
+        self.wrap_width = wrap_width
+        self.line_height = line_height
+        self.pool = ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=init_card_worker,
+            initargs=(self.template, self.font, self.font_size),
+        )
+
+    # Everything that affects how a card looks, used to key cached renders
+    @property
+    def settings(self):
+        return (
+            self.template,
+            self.font,
+            self.font_size,
+            self.wrap_width,
+            self.line_height,
+        )
+
+    async def render(self, text: str):
+        started = monotonic()
+        data = await get_running_loop().run_in_executor(
+            self.pool, render_card, text, self.wrap_width, self.line_height
+        )
+        card_render_seconds.observe(monotonic() - started)
+        return data
+
+    def close(self):
+        self.pool.shutdown(wait=False)
+
+
+# Content addressed disk cache of rendered cards and their uploaded URLs
+class CardCache:
+    def __init__(
+        self,
+        generator: ImageGenerator,
+        directory=bot_dir / "card_cache",
+        max_files: int = 512,
+    ):
+        self.generator = generator
+        self.directory = Path(directory)
+        self.directory.mkdir(exist_ok=True)
+        self.max_files = max_files
+        self.files = len(list(self.directory.glob("*.png")))
+
+        # Content URLs of already uploaded cards, by cache key
+        self.urls_file = self.directory / "uploads.json"
+        try:
+            with open(self.urls_file) as file:
+                self.urls = json.load(file)
+        except (OSError, ValueError):
+            self.urls = {}
+
+    def key(self, text: str):
+        settings = repr((text, self.generator.settings)).encode("utf-8")
+        return sha256(settings).hexdigest()
+
+    async def render(self, text: str):
+        """Get a card's PNG bytes, rendering and storing it if it isn't cached yet."""
+        path = self.directory / f"{self.key(text)}.png"
+        try:
+            data = path.read_bytes()
+            # Bump the modification time so eviction is least recently used
+            path.touch()
+            return data
+        except OSError:
+            pass
+
+        data = await self.generator.render(text)
+        path.write_bytes(data)
+        self.files += 1
+        if self.files > self.max_files:
+            self.evict()
+        return data
+
+    # Delete the least recently used renders until the cache is back under its limit
+    def evict(self):
+        renders = sorted(self.directory.glob("*.png"), key=lambda p: p.stat().st_mtime)
+        for path in renders[: max(len(renders) - self.max_files, 0)]:
+            path.unlink()
+        self.files = min(len(renders), self.max_files)
+
+    async def url(self, ryver: Ryver, text: str):
+        """Get the content URL for a card, only rendering and uploading it once."""
+        key = self.key(text)
+        if key not in self.urls:
+            data = await self.render(text)
+            upload = await ryver.upload_file("black.png", data, "image/png")
+            self.urls[key] = upload.get_content_url()
+            with open(self.urls_file, "w") as file:
+                json.dump(self.urls, file)
+        return self.urls[key]
+
+    async def warm_up(self, texts):
+        """Pre-render cards in the background so their first round doesn't wait on Pillow."""
+        rendered = 0
+        for text in texts:
+            await self.render(text)
+            rendered += 1
+        console.log(f"Pre-rendered {rendered} CAH cards")
+
+
+# Trivia questions and answers, reloaded whenever the file changes
+class TriviaBank:
+    def __init__(self, path=bot_dir / "TriviaQuestions.txt"):
+        self.path = Path(path)
+        self.mtime = None
+        self.questions = ()
+        self.answers = ()
+        self.normalized = ()
+        self.reload()
+
+    # Parse the file into parallel question, answer and normalized answer tuples
+    def reload(self):
+        try:
+            mtime = self.path.stat().st_mtime_ns
+        except OSError:
+            console.log(f"[red]Could not read trivia questions from {self.path}")
+            return
+        if mtime == self.mtime:
+            return
+
+        questions = []
+        answers = []
+        with open(self.path, encoding="utf-8") as file:
+            for number, line in enumerate(file, start=1):
+                line = line.strip()
+                if not line:
+                    continue
+                # Lines are "question,answer", so any other comma makes them ambiguous
+                fields = line.split(",")
+                if len(fields) != 2 or not fields[0].strip() or not fields[1].strip():
+                    console.log(
+                        f"[red]Skipping malformed trivia line {number}: {line!r}"
+                    )
+                    continue
+                questions.append(fields[0].strip())
+                answers.append(fields[1].strip())
+
+        self.mtime = mtime
+        self.questions = tuple(questions)
+        self.answers = tuple(answers)
+        # Normalized once here so checking a guess only normalizes the guess
+        self.normalized = tuple(map(normalize_answer, answers))
+        console.log(f"Loaded {len(self.questions)} trivia questions")
+
+    def __len__(self):
+        self.reload()
+        return len(self.questions)
+
+    def question(self, index: int):
+        return self.questions[index]
+
+    def answer(self, index: int):
+        return self.answers[index]
 
-    def createImage(self, text, filename):
-        img = Image.open(self.src)
+    def normalized_answer(self, index: int):
+        return self.normalized[index]
 
-        text = textwrap.wrap(text, width=17) 
-        font = ImageFont.truetype("Helvetica-Bold.ttf", size=120) 
-        offset = 0 
-        for line in text: 
-            ImageDraw.Draw(img).text((160, 160 + offset), line, font=font) 
-            offset += 140
+    # Plain question files have no categories or difficulties to pick from
+    def filter_names(self):
+        return []
+
+    # Get a random question index, or None if there are no questions
+    def random_index(self, name: str = None):
+        self.reload()
+        if name is not None:
+            raise KeyError(name)
+        if not self.questions:
+            return None
+        return randrange(len(self.questions))
+
+
+# A compiled trivia pack (see trivia.py), read through mmap so only the questions asked
+# are loaded, and reopened whenever the file changes
+class TriviaPack:
+    def __init__(self, path=bot_dir / "TriviaQuestions.tpk"):
+        self.path = Path(path)
+        self.mtime = None
+        self.map = None
+        self.count = 0
+        self.questions_offset = 0
+        # Category or difficulty name -> array offset and length
+        self.indexes = {}
+        self.names = []
+        self.reload()
+
+    def reload(self):
+        try:
+            mtime = self.path.stat().st_mtime_ns
+        except OSError:
+            console.log(f"[red]Could not read the trivia pack {self.path}")
+            return
+        if mtime == self.mtime:
+            return
+
+        try:
+            with open(self.path, "rb") as file:
+                pack = mmap(file.fileno(), 0, access=ACCESS_READ)
+        except (OSError, ValueError):
+            console.log(f"[red]Could not map the trivia pack {self.path}")
+            return
+        header = (None,) * 4
+        if len(pack) >= PACK_HEADER.size:
+            header = PACK_HEADER.unpack_from(pack)
+        magic, version, count, index_count = header
+        if magic != PACK_MAGIC or version != PACK_VERSION:
+            console.log(f"[red]{self.path} is not a version {PACK_VERSION} trivia pack")
+            pack.close()
+            return
+
+        indexes = {}
+        names = []
+        for i in range(index_count):
+            kind, name_length, name_offset, offset, length = PACK_INDEX.unpack_from(
+                pack, PACK_HEADER.size + i * PACK_INDEX.size
+            )
+            name = pack[name_offset : name_offset + name_length].decode("utf-8")
+            indexes[name] = (offset, length)
+            names.append(name)
+
+        # The old mapping is closed by the garbage collector once nothing reads it
+        self.map = pack
+        self.mtime = mtime
+        self.count = count
+        self.questions_offset = PACK_HEADER.size + index_count * PACK_INDEX.size
+        self.indexes = indexes
+        self.names = names
+        console.log(
+            f"Mapped {count} trivia questions "
+            f"with {index_count} categories and difficulties"
+        )
+
+    def __len__(self):
+        self.reload()
+        return self.count
+
+    def record(self, index: int):
+        if not 0 <= index < self.count:
+            raise IndexError(index)
+        return PACK_QUESTION.unpack_from(
+            self.map, self.questions_offset + index * PACK_QUESTION.size
+        )
+
+    def text(self, offset: int, length: int):
+        return self.map[offset : offset + length].decode("utf-8")
+
+    def question(self, index: int):
+        offset, question_length, _, _, _, _ = self.record(index)
+        return self.text(offset, question_length)
+
+    def answer(self, index: int):
+        offset, question_length, answer_length, _, _, _ = self.record(index)
+        return self.text(offset + question_length, answer_length)
+
+    def normalized_answer(self, index: int):
+        offset, question_length, answer_length, length, _, _ = self.record(index)
+        return self.text(offset + question_length + answer_length, length)
+
+    def category(self, index: int):
+        category = self.record(index)[4]
+        return self.names[category] if category != NO_CATEGORY else None
+
+    def difficulty(self, index: int):
+        return DIFFICULTIES[self.record(index)[5]] or None
+
+    def filter_names(self):
+        self.reload()
+        return sorted(self.indexes)
+
+    # Get a random question index, from a category or difficulty if named, or None if
+    # there are no questions. Raises KeyError for unknown names.
+    def random_index(self, name: str = None):
+        self.reload()
+        if name is None:
+            return randrange(self.count) if self.count else None
+        offset, length = self.indexes[name.strip().lower()]
+        if not length:
+            return None
+        return PACK_NUMBER.unpack_from(
+            self.map, offset + randrange(length) * PACK_NUMBER.size
+        )[0]
+
+
+MASK64 = (1 << 64) - 1
+
+
+def mix64(x: int):
+    """Scramble a 64 bit integer (splitmix64's finalizer)."""
+    x = (x + 0x9E3779B97F4A7C15) & MASK64
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & MASK64
+    return x ^ (x >> 31)
+
+
+# A seeded shuffle of range(size) that works out each position on demand, so walking
+# it needs no list of the shuffled items
+class Permutation:
+    ROUNDS = 4
+
+    def __init__(self, size: int, seed: int):
+        self.size = size
+        # A Feistel network is a bijection over an even number of bits, so values that
+        # land past the size are encrypted again until they fall inside it
+        self.half = max(1, ((size - 1).bit_length() + 1) // 2)
+        self.mask = (1 << self.half) - 1
+        self.keys = [mix64(seed + round) for round in range(self.ROUNDS)]
+
+    def encrypt(self, value: int):
+        left, right = value >> self.half, value & self.mask
+        for key in self.keys:
+            left, right = right, left ^ (mix64(right ^ key) & self.mask)
+        return (left << self.half) | right
+
+    def __getitem__(self, position: int):
+        value = self.encrypt(position)
+        while value >= self.size:
+            value = self.encrypt(value)
+        return value
+
+
+# A topic pack file, indexed by the byte offset of each topic's line
+class TopicPack:
+    __slots__ = ("name", "path", "mtime", "offsets")
+
+    def __init__(self, path: Path, mtime: int):
+        self.name = path.stem.lower()
+        self.path = path
+        self.mtime = mtime
+        self.offsets = array("Q")
 
-        img.save(filename)
 
 # The main topic engine
+# Topics are read from pack files on demand, in a shuffled order that doesn't repeat until
+# every topic was given and carries on where it left off after a restart. Lines starting
+# with "#" set the category of the topics after them.
 class TopicGenerator:
-    # Method to shuffle and reset the topics list
-    def shuffle_topics(self):
-        self.topics = sample(self.original_topics, len(self.original_topics))
+    def __init__(self, patterns=("topics.txt",), state=None):
+        self.patterns = tuple(patterns)
+        self.state = state
+        self.packs = []
+        # Index of each pack's first topic, across every pack
+        self.starts = []
+        # Pack or category name -> (start, end) ranges of topic indexes
+        self.filters = {}
+        self.total = 0
+        self.signature = None
+        # Filter name ("*" for every topic) -> seed, position and size of its permutation
+        self.cursors = state.load("topics") if state is not None else {}
+        self.reload()
+
+    def paths(self):
+        paths = []
+        for pattern in self.patterns:
+            # Path.glob() rejects absolute patterns, and bot_dir / pattern keeps them as is
+            for path in map(Path, sorted(glob(str(bot_dir / pattern)))):
+                if path.is_file() and path not in paths:
+                    paths.append(path)
+        return paths
+
+    # Rebuild the index if a pack was added, removed or changed
+    def reload(self):
+        try:
+            signature = [(path, path.stat().st_mtime_ns) for path in self.paths()]
+        except OSError:
+            console.log("[red]Could not read the topic packs")
+            return
+        if signature == self.signature:
+            return
+
+        packs = []
+        starts = []
+        filters = {}
+        total = 0
+        for path, mtime in signature:
+            pack = TopicPack(path, mtime)
+            starts.append(total)
+            category = None
+            offset = 0
+            with open(path, "rb") as file:
+                for line in file:
+                    text = line.strip()
+                    if text.startswith(b"#"):
+                        category = text.lstrip(b"#").strip().decode("utf-8").lower()
+                    elif text:
+                        pack.offsets.append(offset)
+                        if category:
+                            ranges = filters.setdefault(category, [])
+                            # Consecutive topics of a category share a range
+                            if ranges and ranges[-1][1] == total:
+                                ranges[-1][1] += 1
+                            else:
+                                ranges.append([total, total + 1])
+                        total += 1
+                    offset += len(line)
+            packs.append(pack)
 
-    def __init__(self):
-        # Load in the topics from topics.txt
-        with open(bot_dir / "topics.txt") as file:
-            self.original_topics = [line.strip() for line in file.readlines()]
+        # A pack name means the whole pack, even if a category has the same name
+        for pack, start in zip(packs, starts):
+            filters[pack.name] = [[start, start + len(pack.offsets)]]
 
-        # Shuffle as defined previously
-        self.shuffle_topics()
+        self.packs = packs
+        self.starts = starts
+        self.filters = filters
+        self.total = total
+        self.signature = signature
+        console.log(
+            f"Indexed {total} topics from {len(packs)} packs "
+            f"and {len(filters) - len(packs)} categories"
+        )
+
+    def filter_names(self):
+        self.reload()
+        return sorted(self.filters)
+
+    # Read a topic by its index across every pack
+    def read(self, index: int):
+        pack_index = bisect_right(self.starts, index) - 1
+        pack = self.packs[pack_index]
+        with open(pack.path, "rb") as file:
+            file.seek(pack.offsets[index - self.starts[pack_index]])
+            return file.readline().decode("utf-8").strip()
+
+    def topic(self, name: str = None):
+        """
+        Get the next topic, from the named pack or category if given, or None if there
+        are no topics. Raises KeyError for unknown names.
+        """
+        self.reload()
+        if name is None:
+            key, ranges = "*", [[0, self.total]]
+        else:
+            key = name.strip().lower()
+            ranges = self.filters[key]
+        size = sum(end - start for start, end in ranges)
+        if size == 0:
+            return None
 
-    def topic(self):
-        # If out of topics, re-shuffle
-        if len(self.topics) == 0:
-            self.shuffle_topics()
+        # Start a new shuffle once every topic was given or the packs changed size
+        cursor = self.cursors.get(key)
+        if cursor is None or cursor["size"] != size or cursor["position"] >= size:
+            seed = mix64(cursor["seed"]) if cursor is not None else randrange(1 << 63)
+            cursor = {"seed": seed, "position": 0, "size": size}
+        index = Permutation(size, cursor["seed"])[cursor["position"]]
+        cursor["position"] += 1
+        self.cursors[key] = cursor
+        if self.state is not None:
+            self.state.put("topics", key, cursor)
 
-        # Get a random topic while also removing it from the queue
-        return self.topics.pop()
+        # Map the filtered index to a topic index through the filter's ranges
+        for start, end in ranges:
+            if index < end - start:
+                return self.read(start + index)
+            index -= end - start